@@ -1,16 +1,31 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response, make_response, g, stream_with_context, send_from_directory, abort
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from email_notifier import mail, EmailNotifier
+from email_queue import email_queue
+from digests import digests, DIGEST_FREQUENCIES
+from ical_feed import generate_calendar
+from bookings import BookingIndex, booking_bounds, find_conflicts, parse_day
+from response_cache import activity_cache
+from snapshots import snapshots
+from assets import assets
+from compression import compressor
+from usage import usage_rollups, month_of, months_between
+import search
+import background
+from recurrence import RECURRENCE_TYPES, add_months, nth_occurrence, occurrence_dates
 from translations import translations, form_helpers
 from functools import wraps
 from database import db
-from sqlalchemy import text
+from sqlalchemy import text, select, update, delete, insert, func, event
+from sqlalchemy.orm import joinedload, selectinload, Session
 import pytz
-import csv
-from io import StringIO
+import base64
+import json
+import threading
+import zlib
 from datetime import datetime
 
 app = Flask(__name__)
@@ -21,23 +36,91 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_pre_ping": True,
 }
 
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
+# Point MAIL_SERVER/MAIL_PORT at a local SMTP stand-in (MAIL_USE_TLS=0) to try notifications out
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com')
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', '1') == '1'
 app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
+app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER')
+# Activity notifications, on by default once a mail account is configured
+app.config['EMAIL_NOTIFICATIONS'] = os.environ.get('EMAIL_NOTIFICATIONS', '1' if os.environ.get('MAIL_USERNAME') else '0') == '1'
+# Changes to one activity within this window are sent as one message
+app.config['EMAIL_COALESCE_SECONDS'] = int(os.environ.get('EMAIL_COALESCE_SECONDS', 60))
+app.config['EMAIL_FLUSH_INTERVAL'] = int(os.environ.get('EMAIL_FLUSH_INTERVAL', 10))
+app.config['EMAIL_BATCH_SIZE'] = int(os.environ.get('EMAIL_BATCH_SIZE', 50))
+# Failed sends are retried after EMAIL_RETRY_SECONDS, doubling each time
+app.config['EMAIL_MAX_ATTEMPTS'] = int(os.environ.get('EMAIL_MAX_ATTEMPTS', 5))
+app.config['EMAIL_RETRY_SECONDS'] = int(os.environ.get('EMAIL_RETRY_SECONDS', 30))
+# Digest emails go out every day at DIGEST_HOUR, weekly ones on DIGEST_WEEKDAY (0 is Monday)
+app.config['EMAIL_DIGESTS'] = os.environ.get('EMAIL_DIGESTS', '1' if os.environ.get('MAIL_USERNAME') else '0') == '1'
+app.config['DIGEST_HOUR'] = int(os.environ.get('DIGEST_HOUR', 7))
+app.config['DIGEST_WEEKDAY'] = int(os.environ.get('DIGEST_WEEKDAY', 0))
+app.config['DIGEST_SMTP_CONNECTIONS'] = int(os.environ.get('DIGEST_SMTP_CONNECTIONS', 4))
+
+app.config['ACTIVITY_CACHE_MAX_BYTES'] = int(os.environ.get('ACTIVITY_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+app.config['ACTIVITY_CACHE_TTL'] = int(os.environ.get('ACTIVITY_CACHE_TTL', 300))
+app.config['ACTIVITY_CACHE_WARM'] = os.environ.get('ACTIVITY_CACHE_WARM', '1') == '1'
+# Logged-in users are cached per process; other processes see role changes within the TTL
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 60))
+# Windows wider than this (or unbounded ones) are streamed rather than cached
+app.config['ACTIVITY_STREAM_MIN_DAYS'] = int(os.environ.get('ACTIVITY_STREAM_MIN_DAYS', 92))
+app.config['ACTIVITY_STREAM_CHUNK_SIZE'] = int(os.environ.get('ACTIVITY_STREAM_CHUNK_SIZE', 500))
+# Text responses at least this large are gzip/brotli compressed for clients that accept it
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+app.config['COMPRESS_GZIP_LEVEL'] = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+app.config['COMPRESS_BROTLI_QUALITY'] = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+app.config['IMPORT_CHUNK_SIZE'] = int(os.environ.get('IMPORT_CHUNK_SIZE', 1000))
+app.config['IMPORT_WORKERS'] = int(os.environ.get('IMPORT_WORKERS', 2))
+app.config['BACKGROUND_WORKERS'] = int(os.environ.get('BACKGROUND_WORKERS', 2))
+# Public month snapshots: where they are written, which months, and how long
+# after a change the rebuild waits so a burst of edits renders once
+app.config['SNAPSHOT_DIR'] = os.environ.get('SNAPSHOT_DIR', os.path.join(app.instance_path, 'snapshots'))
+app.config['SNAPSHOT_MONTHS_BEFORE'] = int(os.environ.get('SNAPSHOT_MONTHS_BEFORE', 1))
+app.config['SNAPSHOT_MONTHS_AFTER'] = int(os.environ.get('SNAPSHOT_MONTHS_AFTER', 12))
+app.config['SNAPSHOT_REBUILD_DELAY'] = int(os.environ.get('SNAPSHOT_REBUILD_DELAY', 5))
+# Usage rollups of the months a write touched are recomputed this long after it
+app.config['USAGE_REFRESH_DELAY'] = int(os.environ.get('USAGE_REFRESH_DELAY', 30))
+# Longest period one usage report may cover
+app.config['USAGE_REPORT_MAX_MONTHS'] = int(os.environ.get('USAGE_REPORT_MAX_MONTHS', 120))
+# Delta sync (/api/activities/changes): deletions are remembered this long, and
+# changes this recent are sent again on the next sync in case a slower
+# transaction commits an earlier updated_at after them
+app.config['SYNC_TOMBSTONE_DAYS'] = int(os.environ.get('SYNC_TOMBSTONE_DAYS', 90))
+app.config['SYNC_SETTLE_SECONDS'] = int(os.environ.get('SYNC_SETTLE_SECONDS', 10))
+# How far past today open-ended series are expanded when no end is requested
+app.config['RECURRENCE_HORIZON_DAYS'] = int(os.environ.get('RECURRENCE_HORIZON_DAYS', 365))
+# Length assumed for bookings without an end time when checking room conflicts
+app.config['BOOKING_DEFAULT_MINUTES'] = int(os.environ.get('BOOKING_DEFAULT_MINUTES', 60))
+# Longest date range one availability search may sweep
+app.config['AVAILABILITY_MAX_DAYS'] = int(os.environ.get('AVAILABILITY_MAX_DAYS', 62))
+# Subscription feeds cover this many days back; forward they reach the recurrence horizon
+app.config['ICAL_PAST_DAYS'] = int(os.environ.get('ICAL_PAST_DAYS', 90))
+app.config['ICAL_TIMEZONE'] = os.environ.get('ICAL_TIMEZONE', 'America/Toronto')
+app.config['ICAL_UID_DOMAIN'] = os.environ.get('ICAL_UID_DOMAIN', 'calendrier-cfsj')
 
 db.init_app(app)
 mail.init_app(app)
+email_queue.init_app(app, mail=mail, render=EmailNotifier.render)
+activity_cache.init_app(app)
+background.init_app(app)
+assets.init_app(app)
+compressor.init_app(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-from models import User, Category, Activity, Location
+from models import User, Category, Activity, ActivityException, ActivityTombstone, Location, DataVersion, activity_categories
+from csv_import import (import_activities_csv, found_activities, wrote_activities, external_key, ImportFormatError,
+                        IMPORT_MODES, CONTRACT_PATTERN)
+from import_jobs import import_jobs
+from user_cache import user_cache
+
+user_cache.init_app(app)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.load(int(user_id))
 
 def get_translations():
     return translations['fr'], form_helpers['fr']
@@ -95,10 +178,130 @@ def manage_users():
     users = User.query.all()
     return render_template('users.html', users=users, trans=trans, helpers=helpers)
 
-@app.route('/api/activities', methods=['GET'])
-def get_activities():
-    activities = Activity.query.all()
-    return jsonify([{
+CALENDAR_VERSION = 'calendar'
+
+def load_data_version():
+    if 'data_version' not in g:
+        row = db.session.execute(
+            select(DataVersion.version, DataVersion.updated_at).where(DataVersion.name == CALENDAR_VERSION)
+        ).first()
+        g.data_version, g.data_updated_at = (row.version or 0, row.updated_at) if row else (0, None)
+
+def get_data_version():
+    load_data_version()
+    return g.data_version
+
+def get_data_updated_at():
+    """When calendar data last changed, None if never recorded."""
+    load_data_version()
+    return g.data_updated_at
+
+def bump_data_version():
+    """Invalidate every versioned read; call before committing a calendar write."""
+    result = db.session.execute(
+        update(DataVersion)
+        .where(DataVersion.name == CALENDAR_VERSION)
+        .values(version=DataVersion.version + 1, updated_at=datetime.utcnow())
+    )
+    if result.rowcount == 0:
+        db.session.add(DataVersion(name=CALENDAR_VERSION, version=1, updated_at=datetime.utcnow()))
+    g.pop('data_version', None)
+    g.pop('data_updated_at', None)
+    # Entries are keyed by version so other workers never serve stale data;
+    # clearing here just releases this worker's memory straight away.
+    activity_cache.clear()
+    db.session.info['calendar_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def rebuild_snapshots_after_commit(session):
+    # Scheduled only once the new version is visible to the rebuild
+    if session.info.pop('calendar_changed', False):
+        snapshots.schedule_rebuild()
+        usage_rollups.schedule_refresh()
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_calendar_change(session, previous_transaction):
+    session.info.pop('calendar_changed', None)
+
+@event.listens_for(Session, 'before_flush')
+def touch_changed_activities(session, flush_context, instances):
+    # updated_at's onupdate only fires when an activity column changes; a new
+    # category list or an edited exception must show up in delta sync too
+    now = datetime.utcnow()
+    for instance in session.dirty:
+        if isinstance(instance, Activity) and session.is_modified(instance):
+            instance.updated_at = now
+    with session.no_autoflush:
+        for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(instance, ActivityException) and instance.activity_id:
+                series = session.get(Activity, instance.activity_id)
+                if series is not None and series not in session.deleted:
+                    series.updated_at = now
+
+def versioned(view):
+    """Answer If-None-Match with a 304 when the calendar data version is unchanged.
+
+    The ETag is weak since the body may be sent gzip or brotli encoded.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        etag = f'v{get_data_version()}-{zlib.crc32(request.query_string):08x}'
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return wrapper
+
+def parse_date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d')
+
+def filter_activities_by_window(query, start=None, end=None, location_id=None, category_id=None):
+    # An activity overlaps [start, end] when it starts before the day after `end`
+    # and is still running after `start` (or starts on it, for zero-length ones).
+    # Both sides are kept as plain column comparisons so the start_at/end_at indexes apply.
+    if end:
+        query = query.filter(Activity.start_at < end + timedelta(days=1))
+    if start:
+        query = query.filter(db.or_(
+            Activity.end_at > start,
+            Activity.start_at >= start,
+            # Series rows stand for all their occurrences; multi-day ones are
+            # always kept and trimmed precisely when expanded.
+            db.and_(Activity.is_series.is_(True), db.or_(
+                Activity.recurrence_end_date.is_(None),
+                Activity.recurrence_end_date >= start,
+                Activity.end_date.isnot(None)
+            ))
+        ))
+    if location_id:
+        query = query.filter(db.or_(
+            Activity.location_id == location_id,
+            Activity.exceptions.any(ActivityException.location_id == location_id)
+        ))
+    if category_id:
+        query = query.filter(Activity.categories.any(Category.id == category_id))
+    return query
+
+def activity_read_options():
+    # Location is many-to-one and joins into the main SELECT; categories come
+    # from a single "WHERE activity_id IN (...)" query, so serializing a list
+    # costs two round trips regardless of its length.
+    return [
+        joinedload(Activity.location_obj),
+        selectinload(Activity.categories),
+        selectinload(Activity.exceptions).joinedload(ActivityException.location_obj)
+    ]
+
+def serialize_activity(activity):
+    return {
         'id': activity.id,
         'title': activity.title,
         'date': activity.date.strftime('%Y-%m-%d'),
@@ -116,38 +319,506 @@ def get_activities():
         'is_recurring': activity.is_recurring,
         'recurrence_type': activity.recurrence_type,
         'recurrence_end_date': activity.recurrence_end_date.strftime('%Y-%m-%d') if activity.recurrence_end_date else None,
-        'is_all_day': activity.is_all_day
-    } for activity in activities])
+        'is_all_day': activity.is_all_day,
+        'is_series': activity.is_series,
+        'series_id': activity.series_id,
+        'client_count': activity.client_count
+    }
+
+def expand_series(activity, start=None, end=None):
+    """Occurrences of a series overlapping [start, end], with exceptions applied."""
+    lower = start or activity.date
+    if end is None:
+        end = datetime.now() + timedelta(days=app.config['RECURRENCE_HORIZON_DAYS'])
+    duration = activity.end_date - activity.date if activity.end_date else timedelta(0)
+    exceptions = {exception.occurrence_date.date(): exception for exception in activity.exceptions}
+    base = serialize_activity(activity)
+
+    for occurrence in occurrence_dates(activity.date, activity.recurrence_type, lower, end + timedelta(days=1),
+                                       until=activity.recurrence_end_date, duration=duration):
+        exception = exceptions.get(occurrence.date())
+        if exception and exception.is_cancelled:
+            continue
+        item = dict(base,
+                    date=occurrence.strftime('%Y-%m-%d'),
+                    end_date=(occurrence + duration).strftime('%Y-%m-%d') if activity.end_date else None,
+                    series_id=activity.id,
+                    occurrence_date=occurrence.strftime('%Y-%m-%d'))
+        if exception:
+            for field in ('title', 'time', 'end_time', 'notes'):
+                if getattr(exception, field) is not None:
+                    item[field] = getattr(exception, field)
+            if exception.location_id is not None:
+                item['location_id'] = exception.location_id
+                item['location'] = exception.location_obj.name
+        yield item
+
+def iter_activity_dicts(activities, start=None, end=None, location_id=None):
+    for activity in activities:
+        if activity.is_series:
+            for occurrence in expand_series(activity, start, end):
+                # An exception may have moved this occurrence to another room
+                if not location_id or occurrence['location_id'] == location_id:
+                    yield occurrence
+        else:
+            yield serialize_activity(activity)
+
+# Columns of the ?format=compact listing: each row is a list of these values,
+# and categories are sent once in a map keyed by id instead of in every row
+COMPACT_FIELDS = ('id', 'title', 'date', 'time', 'end_date', 'end_time', 'location', 'location_id',
+                  'category_ids', 'notes', 'is_recurring', 'recurrence_type', 'recurrence_end_date',
+                  'is_all_day', 'is_series', 'series_id', 'client_count', 'occurrence_date')
+
+def compact_rows(items, categories):
+    """COMPACT_FIELDS rows of `items`, adding the categories they use to `categories`."""
+    for item in items:
+        for category_id, category in zip(item['category_ids'], item['categories']):
+            categories[category_id] = category
+        yield [item.get(field) for field in COMPACT_FIELDS]
+
+def activity_listing_json(start, end, location_id=None, category_id=None, compact=False):
+    key = (get_data_version(), start, end, location_id, category_id, compact)
+    body = activity_cache.get(key)
+    if body is None:
+        activities = filter_activities_by_window(
+            Activity.query,
+            start=start,
+            end=end,
+            location_id=location_id,
+            category_id=category_id
+        ).options(*activity_read_options()).all()
+        items = iter_activity_dicts(activities, start, end, location_id)
+        if compact:
+            categories = {}
+            rows = list(compact_rows(items, categories))
+            listing = {'fields': COMPACT_FIELDS, 'categories': categories, 'rows': rows}
+        else:
+            listing = list(items)
+        body = app.json.dumps(listing).encode('utf-8')
+        activity_cache.set(key, body)
+    return body
+
+def stream_activities_json(query, start=None, end=None, location_id=None, compact=False):
+    """Serialize a query as a JSON array, one chunk of rows at a time.
+
+    yield_per() makes the driver use a server-side cursor and runs the
+    selectin category load once per chunk, so memory stays bounded by the
+    chunk size rather than the size of the result. The compact format's
+    category map is only known at the end, so it follows the rows.
+    """
+    chunk_size = app.config['ACTIVITY_STREAM_CHUNK_SIZE']
+
+    def generate():
+        categories = {}
+        yield f'{{"fields":{app.json.dumps(COMPACT_FIELDS)},"rows":[' if compact else '['
+        separator = ''
+        chunk = []
+        activities = query.options(*activity_read_options()).yield_per(chunk_size)
+        items = iter_activity_dicts(activities, start, end, location_id)
+        for item in compact_rows(items, categories) if compact else items:
+            chunk.append(app.json.dumps(item))
+            if len(chunk) == chunk_size:
+                yield separator + ','.join(chunk)
+                separator = ','
+                chunk = []
+        if chunk:
+            yield separator + ','.join(chunk)
+        yield f'],"categories":{app.json.dumps(categories)}}}' if compact else ']'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def warm_activity_cache():
+    """Pre-serialize the current and next month as calendar.js requests them."""
+    month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    with app.app_context():
+        for _ in range(2):
+            next_month = (month_start + timedelta(days=32)).replace(day=1)
+            activity_listing_json(month_start, next_month - timedelta(days=1), compact=True)
+            month_start = next_month
+
+snapshots.init_app(app, render=activity_listing_json, current_version=get_data_version)
+
+def usage_activities(start, end):
+    query = filter_activities_by_window(Activity.query, start=start, end=end)
+    activities = query.options(*activity_read_options()).yield_per(app.config['ACTIVITY_STREAM_CHUNK_SIZE'])
+    return iter_activity_dicts(activities, start, end)
+
+usage_rollups.init_app(app, collect=usage_activities)
+
+def digest_activities(start, end, changed_since):
+    """Occurrences overlapping [start, end] and activities changed since
+    `changed_since`, loaded with one query for every digest of a run."""
+    in_window = filter_activities_by_window(select(Activity.id), start=start, end=end)
+    activities = Activity.query.filter(db.or_(
+        Activity.id.in_(in_window),
+        Activity.updated_at >= changed_since
+    )).options(*activity_read_options()).order_by(Activity.start_at, Activity.id).all()
+
+    first, last = start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+    upcoming = sorted((item for item in iter_activity_dicts(activities, start, end)
+                       if item['date'] <= last and (item['end_date'] or item['date']) >= first),
+                      key=lambda item: (item['date'], item['time'] or ''))
+    changed = [dict(serialize_activity(activity), updated_at=activity.updated_at,
+                    created=bool(activity.created_at and activity.created_at >= changed_since))
+               for activity in activities if activity.updated_at and activity.updated_at >= changed_since]
+    return upcoming, changed
+
+digests.init_app(app, mail=mail, collect=digest_activities, render=EmailNotifier.render_digest)
+
+@app.route('/share/<token>')
+def public_calendar(token):
+    if not User.query.filter_by(share_token=token).first():
+        abort(404)
+    if snapshots.is_stale(get_data_version()):
+        snapshots.schedule_rebuild(delay=0)
+    trans, helpers = get_translations()
+    return render_template('public_calendar.html', trans=trans, helpers=helpers,
+                           snapshot_manifest_url=url_for('snapshot_file', filename='manifest.json'))
+
+@app.route('/snapshots/<path:filename>')
+def snapshot_file(filename):
+    """Month files are named by content hash and never change; only the
+    manifest is revalidated."""
+    if filename == 'manifest.json':
+        response = send_from_directory(app.config['SNAPSHOT_DIR'], filename, max_age=0)
+        response.cache_control.no_cache = True
+        return response
+    response = send_from_directory(app.config['SNAPSHOT_DIR'], filename, max_age=365 * 24 * 3600)
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/api/activities', methods=['GET'])
+@versioned
+def get_activities():
+    try:
+        start = parse_date_arg('start')
+        end = parse_date_arg('end')
+    except ValueError:
+        return jsonify({'error': 'Invalid date, expected YYYY-MM-DD'}), 400
+    if start and end and start > end:
+        return jsonify({'error': 'start must be before end'}), 400
+
+    location_id = request.args.get('location_id', type=int)
+    category_id = request.args.get('category_id', type=int)
+    compact = request.args.get('format') == 'compact'
+    wide_window = not (start and end) or (end - start).days > app.config['ACTIVITY_STREAM_MIN_DAYS']
+    if request.args.get('stream') == '1' or wide_window:
+        query = filter_activities_by_window(
+            Activity.query,
+            start=start,
+            end=end,
+            location_id=location_id,
+            category_id=category_id
+        )
+        return stream_activities_json(query, start, end, location_id, compact=compact)
+
+    body = activity_listing_json(start, end, location_id=location_id, category_id=category_id, compact=compact)
+    return Response(body, mimetype='application/json')
+
+@app.route('/calendar/<token>.ics')
+def calendar_feed(token):
+    """iCalendar subscription feed for a user's share token.
+
+    Every token sees the same calendar, so the body is cached once per data
+    version and day (the window moves daily). Polling clients revalidate with
+    If-None-Match / If-Modified-Since and get a 304 without the activity query.
+    """
+    if not User.query.filter_by(share_token=token).first():
+        return Response('Not found', status=404, mimetype='text/plain')
+
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    version = get_data_version()
+    # Last-Modified and DTSTAMP are UTC like DataVersion.updated_at; the day
+    # the window moves on starts at local midnight
+    today_utc = today.astimezone(timezone.utc).replace(tzinfo=None)
+    updated_at = get_data_updated_at()
+    last_modified = max(updated_at, today_utc) if updated_at else today_utc
+    etag = f'ics-v{version}-{today:%Y%m%d}'
+
+    not_modified = request.if_none_match.contains_weak(etag) if request.if_none_match else (
+        request.if_modified_since is not None
+        and request.if_modified_since.replace(tzinfo=None) >= last_modified.replace(microsecond=0)
+    )
+    if not_modified:
+        response = Response(status=304)
+    else:
+        key = ('ics', version, today)
+        body = activity_cache.get(key)
+        if body is not None:
+            response = Response(body, mimetype='text/calendar')
+        else:
+            start = today - timedelta(days=app.config['ICAL_PAST_DAYS'])
+            end = today + timedelta(days=app.config['RECURRENCE_HORIZON_DAYS'])
+            response = Response(stream_with_context(ical_feed_chunks(key, start, end, last_modified)),
+                                mimetype='text/calendar')
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def ical_feed_chunks(cache_key, start, end, stamp):
+    """Stream the feed a chunk of rows at a time, caching the body once complete."""
+    query = filter_activities_by_window(Activity.query, start=start, end=end).order_by(Activity.start_at, Activity.id)
+    activities = query.options(*activity_read_options()).yield_per(app.config['ACTIVITY_STREAM_CHUNK_SIZE'])
+    parts = []
+    for chunk in generate_calendar(iter_activity_dicts(activities, start, end), 'Calendrier CFSJ',
+                                   app.config['ICAL_TIMEZONE'], stamp, app.config['ICAL_UID_DOMAIN']):
+        chunk = chunk.encode('utf-8')
+        parts.append(chunk)
+        yield chunk
+    activity_cache.set(cache_key, b''.join(parts))
+
+@app.route('/api/share-token', methods=['POST'])
+@login_required
+def create_share_token():
+    """Return the current user's feed URL, issuing a token on first use or
+    a new one (revoking the old) when `regenerate` is set."""
+    try:
+        if not current_user.share_token or (request.get_json(silent=True) or {}).get('regenerate'):
+            current_user.generate_share_token()
+            db.session.commit()
+        return jsonify({
+            'success': True,
+            'share_token': current_user.share_token,
+            'ics_url': url_for('calendar_feed', token=current_user.share_token, _external=True)
+        })
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/api/activities/<int:activity_id>', methods=['GET'])
+@versioned
 def get_activity(activity_id):
-    activity = Activity.query.get_or_404(activity_id)
-    print(f"Fetching activity {activity_id}:")
-    print(f"Location ID: {activity.location_id}")
-    print(f"Category IDs: {[c.id for c in activity.categories]}")
-    
-    response_data = {
-        'id': activity.id,
-        'title': activity.title,
-        'date': activity.date.strftime('%Y-%m-%d'),
-        'time': activity.time,
-        'end_date': activity.end_date.strftime('%Y-%m-%d') if activity.end_date else None,
-        'end_time': activity.end_time,
-        'location': activity.location_obj.name if activity.location_obj else None,
-        'location_id': activity.location_id,
-        'notes': activity.notes,
-        'is_all_day': activity.is_all_day,
-        'is_recurring': activity.is_recurring,
-        'categories': [{
-            'name': category.name,
-            'color': category.color
-        } for category in activity.categories],
-        'category_ids': [category.id for category in activity.categories],
-        'recurrence_type': activity.recurrence_type,
-        'recurrence_end_date': activity.recurrence_end_date.strftime('%Y-%m-%d') if activity.recurrence_end_date else None
-    }
-    print("Response data:", response_data)
-    return jsonify(response_data)
+    activity = Activity.query.options(*activity_read_options()).filter_by(id=activity_id).first_or_404()
+    return jsonify(serialize_activity(activity))
+
+def encode_cursor(activity):
+    payload = json.dumps([activity.start_at.isoformat(), activity.id])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    date_str, activity_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return datetime.fromisoformat(date_str), int(activity_id)
+
+@app.route('/api/admin/activities', methods=['GET'])
+@login_required
+def get_admin_activities():
+    """One page of the admin table, ordered by (start_at, id) and paged by cursor."""
+    if not current_user.can_manage_activities():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    descending = request.args.get('order', 'desc') != 'asc'
+    try:
+        cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    query = filter_activities_by_window(
+        Activity.query,
+        start=today if request.args.get('upcoming') == '1' else None,
+        location_id=request.args.get('location_id', type=int),
+        category_id=request.args.get('category_id', type=int)
+    )
+
+    terms = search.search_terms(request.args.get('q', ''))
+    if terms:
+        query = query.filter(search.match_condition(terms))
+
+    if cursor:
+        cursor_start, cursor_id = cursor
+        if descending:
+            query = query.filter(db.or_(
+                Activity.start_at < cursor_start,
+                db.and_(Activity.start_at == cursor_start, Activity.id < cursor_id)
+            ))
+        else:
+            query = query.filter(db.or_(
+                Activity.start_at > cursor_start,
+                db.and_(Activity.start_at == cursor_start, Activity.id > cursor_id)
+            ))
+
+    if descending:
+        query = query.order_by(Activity.start_at.desc(), Activity.id.desc())
+    else:
+        query = query.order_by(Activity.start_at.asc(), Activity.id.asc())
+
+    # Fetch one extra row to know whether another page exists
+    activities = query.options(*activity_read_options()).limit(limit + 1).all()
+    has_more = len(activities) > limit
+    activities = activities[:limit]
+    return jsonify({
+        'activities': [serialize_activity(activity) for activity in activities],
+        'next_cursor': encode_cursor(activities[-1]) if has_more else None
+    })
+
+@app.route('/api/activities/search', methods=['GET'])
+@login_required
+def search_activities():
+    """Activities whose title, notes or room match every word of `q` (as
+    prefixes), best matches first, optionally limited to a date window."""
+    terms = search.search_terms(request.args.get('q', ''))
+    if not terms:
+        return jsonify({'error': f'Search terms need at least {search.MIN_TERM_LENGTH} characters'}), 400
+    try:
+        start = parse_date_arg('start')
+        end = parse_date_arg('end')
+    except ValueError:
+        return jsonify({'error': 'Invalid date, expected YYYY-MM-DD'}), 400
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+
+    matches = search.ranked_matches(terms)
+    query = filter_activities_by_window(
+        db.session.query(Activity.id, matches.c.rank).join(matches, matches.c.id == Activity.id),
+        start=start,
+        end=end,
+        location_id=request.args.get('location_id', type=int),
+        category_id=request.args.get('category_id', type=int)
+    )
+    ranked = query.order_by(matches.c.rank, Activity.start_at, Activity.id).limit(limit).all()
+
+    activities = {activity.id: activity for activity in Activity.query.options(*activity_read_options())
+                  .filter(Activity.id.in_([activity_id for activity_id, _ in ranked]))}
+    results = []
+    for activity_id, rank in ranked:
+        result = serialize_activity(activities[activity_id])
+        result['rank'] = -rank
+        results.append(result)
+    return jsonify({'query': ' '.join(terms), 'results': results})
+
+def encode_sync_cursor(changed, deleted):
+    payload = json.dumps([changed[0].isoformat(), changed[1], deleted[0].isoformat(), deleted[1]])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_sync_cursor(cursor):
+    changed_at, activity_id, deleted_at, tombstone_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return (datetime.fromisoformat(changed_at), int(activity_id)), (datetime.fromisoformat(deleted_at), int(tombstone_id))
+
+def after_key(timestamp_column, id_column, key):
+    timestamp, row_id = key
+    return db.or_(timestamp_column > timestamp, db.and_(timestamp_column == timestamp, id_column > row_id))
+
+def serialize_change(activity):
+    # Series rows are sent unexpanded, with their exceptions, so a client
+    # holding them can expand any window itself
+    item = serialize_activity(activity)
+    item['updated_at'] = activity.updated_at.isoformat()
+    if activity.is_series:
+        item['exceptions'] = [{
+            'occurrence_date': exception.occurrence_date.strftime('%Y-%m-%d'),
+            'is_cancelled': exception.is_cancelled,
+            'title': exception.title,
+            'time': exception.time,
+            'end_time': exception.end_time,
+            'notes': exception.notes,
+            'location_id': exception.location_id,
+            'location': exception.location_obj.name if exception.location_obj else None
+        } for exception in activity.exceptions]
+    return item
+
+@app.route('/api/activities/changes', methods=['GET'])
+@versioned
+def get_activity_changes():
+    """Activities created or updated, and ids of those deleted, since `since`.
+
+    Without `since` every activity is returned (over as many pages as it
+    takes) and the cursor of the last page is kept for the next sync. Pages
+    are keyset ordered by (updated_at, id) and (deleted_at, tombstone id);
+    pass the returned `cursor` as `since` while `has_more` is true.
+
+    Applying a page is idempotent, and the cursor after the last page trails
+    by SYNC_SETTLE_SECONDS so the newest changes are sent twice rather than
+    missed when an earlier transaction commits late. Cursors older than
+    SYNC_TOMBSTONE_DAYS get a 410: the client must start over.
+    """
+    limit = min(max(request.args.get('limit', 500, type=int), 1), 1000)
+    now = datetime.utcnow()
+    settled = (now - timedelta(seconds=app.config['SYNC_SETTLE_SECONDS']), 0)
+    if request.args.get('since'):
+        try:
+            changed_key, deleted_key = decode_sync_cursor(request.args['since'])
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Invalid cursor'}), 400
+        if deleted_key[0] < now - timedelta(days=app.config['SYNC_TOMBSTONE_DAYS']):
+            return jsonify({'error': 'Cursor expired, reload every activity'}), 410
+    else:
+        # A full copy needs no deletions from before it
+        changed_key, deleted_key = (datetime.min, 0), settled
+
+    activities = Activity.query.filter(
+        after_key(Activity.updated_at, Activity.id, changed_key)
+    ).options(*activity_read_options()).order_by(Activity.updated_at, Activity.id).limit(limit + 1).all()
+    # An id deleted and then reused by a new row (SQLite may) is sent as a change only
+    tombstones = db.session.execute(
+        select(ActivityTombstone)
+        .where(after_key(ActivityTombstone.deleted_at, ActivityTombstone.id, deleted_key),
+               ActivityTombstone.activity_id.not_in(select(Activity.id)))
+        .order_by(ActivityTombstone.deleted_at, ActivityTombstone.id)
+        .limit(limit + 1)
+    ).scalars().all()
+
+    more_changed = len(activities) > limit
+    more_deleted = len(tombstones) > limit
+    activities = activities[:limit]
+    tombstones = tombstones[:limit]
+    if more_changed:
+        changed_key = (activities[-1].updated_at, activities[-1].id)
+    else:
+        changed_key = settled
+    if more_deleted:
+        deleted_key = (tombstones[-1].deleted_at, tombstones[-1].id)
+    else:
+        deleted_key = settled
+    return jsonify({
+        'activities': [serialize_change(activity) for activity in activities],
+        'deleted': [{'id': tombstone.activity_id, 'deleted_at': tombstone.deleted_at.isoformat()}
+                    for tombstone in tombstones],
+        'cursor': encode_sync_cursor(changed_key, deleted_key),
+        'has_more': more_changed or more_deleted
+    })
+
+def parse_month_arg(name, default):
+    value = request.args.get(name)
+    return datetime.strptime(value, '%Y-%m') if value else default
+
+@app.route('/api/analytics/usage', methods=['GET'])
+@login_required
+def get_usage_report():
+    """Bookings, hours booked and clients per month, room and category over
+    the months `start`..`end` (YYYY-MM, the last twelve months by default)."""
+    if not current_user.can_manage_activities():
+        return jsonify({'error': 'Unauthorized'}), 403
+    this_month = month_of(datetime.now())
+    try:
+        first = parse_month_arg('start', add_months(this_month, -11))
+        last = parse_month_arg('end', this_month)
+    except ValueError:
+        return jsonify({'error': 'Invalid month, expected YYYY-MM'}), 400
+    if first > last:
+        return jsonify({'error': 'start must be before end'}), 400
+    if len(list(months_between(first, last))) > app.config['USAGE_REPORT_MAX_MONTHS']:
+        return jsonify({'error': f"At most {app.config['USAGE_REPORT_MAX_MONTHS']} months per report"}), 400
+    return jsonify(usage_rollups.report(first, last, location_id=request.args.get('location_id', type=int)))
+
+@app.route('/api/analytics/rebuild', methods=['POST'])
+@login_required
+def rebuild_usage_rollups():
+    if not current_user.can_manage_users():
+        return jsonify({'error': 'Unauthorized'}), 403
+    try:
+        usage_rollups.rebuild()
+        return jsonify({'success': True}), 202
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/cache-stats', methods=['GET'])
+@login_required
+def get_cache_stats():
+    if not current_user.can_manage_users():
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify({'activities': activity_cache.stats(), 'users': user_cache.stats()})
 
 @app.route('/api/import-activities', methods=['POST'])
 @login_required
@@ -162,145 +833,196 @@ def import_activities():
     if not file.filename.endswith('.csv'):
         return jsonify({'error': 'Invalid file type'}), 400
 
-    try:
+    # 'upsert' re-syncs a repeated export; 'append' inserts every row again
+    mode = request.args.get('mode', 'upsert')
+    if mode not in IMPORT_MODES:
+        return jsonify({'error': 'Invalid import mode'}), 400
+    # Lets an upsert remove more of the bookings it covers than it otherwise would
+    confirm_removal = request.args.get('confirm_removal') == '1'
+
+    if request.args.get('sync') != '1':
         try:
-            # Read CSV file and skip empty rows at the beginning
-            content = file.stream.read().decode("UTF-8-sig")  # Handle BOM if present
-            print("Reading CSV content...")
-            
-            # Print first few lines for debugging
-            lines = content.split('\n')
-            print("First 5 lines of CSV:")
-            for i, line in enumerate(lines[:5]):
-                print(f"Line {i}: {line}")
-            
-            # Skip empty lines and metadata at the start
-            lines = [line for line in lines if line.strip()]
-            
-            # Find the header row (looking for key columns)
-            header_index = -1
-            key_columns = ["Date de l'évènement", "Nom de la salle", "Heure de début"]
-            
-            for i, line in enumerate(lines):
-                if any(col in line for col in key_columns):
-                    header_index = i
-                    print(f"Found header at line {i}: {line}")
-                    break
-            
-            if header_index == -1:
-                print("Could not find header row in CSV")
-                return jsonify({'error': 'Invalid CSV format: header row not found'}), 400
-            
-            # Reconstruct CSV with correct header
-            csv_content = '\n'.join(lines[header_index:])
-            stream = StringIO(csv_content)
-            csv_reader = csv.DictReader(stream, delimiter=';')
-            
-            print("CSV Headers found:", csv_reader.fieldnames)
-            
-            activities_to_create = []
-            for row in csv_reader:
-                # Skip empty rows
-                if not any(row.values()):
-                    continue
-                
-                try:
-                    # Parse date
-                    date_str = row.get("Date de l'évènement", '').strip()
-                    if not date_str:
-                        print(f"Skipping row - no date found: {row}")
-                        continue
-                        
-                    try:
-                        date = datetime.strptime(date_str, '%d-%m-%Y')
-                    except ValueError as e:
-                        print(f"Error parsing date {date_str}: {e}")
-                        continue
-
-                    # Get or create location
-                    location_name = row.get('Nom de la salle', '').strip()
-                    location = None
-                    if location_name:
-                        location = Location.query.filter_by(name=location_name).first()
-                        if not location:
-                            location = Location(name=location_name)
-                            db.session.add(location)
-                            db.session.flush()
-
-                    # Get event title
-                    title = row.get("Nom de l'événement ou de type", '').strip()
-                    if not title:
-                        title = row.get("nom de l'événement", '').strip()
-                    if not title:
-                        title = 'Événement importé'
-
-                    # Parse times
-                    start_time = row.get('Heure de début', '').strip()
-                    end_time = row.get('Heure de fin', '').strip()
-                    
-                    # Format times to 24-hour format if they exist
-                    if start_time:
-                        try:
-                            # Handle format "07H00"
-                            start_time = start_time.upper().replace('H', ':')
-                            if len(start_time) == 4:  # Format "7:00"
-                                start_time = f"0{start_time}"
-                        except ValueError as e:
-                            print(f"Error parsing start time {start_time}: {e}")
-                            start_time = None
-                            
-                    if end_time:
-                        try:
-                            # Handle format "07H00"
-                            end_time = end_time.upper().replace('H', ':')
-                            if len(end_time) == 4:  # Format "7:00"
-                                end_time = f"0{end_time}"
-                        except ValueError as e:
-                            print(f"Error parsing end time {end_time}: {e}")
-                            end_time = None
-
-                    print(f"Processing row: Date={date_str}, Title={title}, Time={start_time}-{end_time}, Location={location_name}")
-
-            # Create activity with all available information
-                    activity = Activity(
-                        title=title,
-                        date=date,
-                        time=start_time,
-                        end_time=end_time,
-                        location_id=location.id if location else None,
-                        notes=row.get("Contrat #", '').strip(),  # Using contract number as notes
-                        is_all_day=not bool(start_time),
-                        is_recurring=False
-                    )
-                    activities_to_create.append(activity)
-                    print(f"Activity prepared: {activity.title} on {activity.date}")
-                    
-                except Exception as row_error:
-                    print(f"Error processing row: {row_error}")
-                    continue
-
-            if not activities_to_create:
-                print("No valid activities found in CSV")
-                return jsonify({'error': 'No valid activities found in CSV'}), 400
-
-            # Save all activities
-            print(f"Attempting to save {len(activities_to_create)} activities...")
-            for activity in activities_to_create:
-                db.session.add(activity)
-            
-            db.session.commit()
-            print(f"Successfully imported {len(activities_to_create)} activities")
-            return jsonify({'success': True, 'count': len(activities_to_create)})
-            
+            job = import_jobs.submit(file, current_user.id, mode, confirm_removal)
         except Exception as e:
-            print(f"Error processing CSV: {str(e)}")
-            return jsonify({'error': f'Error processing CSV: {str(e)}'}), 500
+            return jsonify({'error': str(e)}), 500
+        return jsonify({
+            'success': True,
+            'job_id': job.id,
+            'status_url': url_for('get_import_job', job_id=job.id)
+        }), 202
 
+    try:
+        report = import_activities_csv(file.stream, chunk_size=app.config['IMPORT_CHUNK_SIZE'], mode=mode,
+                                       conflict_checker=booking_conflicts,
+                                       delete_activities=delete_activities_where, confirm_removal=confirm_removal)
+        if not found_activities(report):
+            db.session.rollback()
+            return jsonify({'error': 'No valid activities found in CSV', **report}), 400
+
+        if wrote_activities(report):
+            bump_data_version()
+        db.session.commit()
+        return jsonify({'success': True, **report})
+    except ImportFormatError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         db.session.rollback()
-        print('Error importing activities:', str(e))
+        app.logger.exception('Error importing activities')
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/import-jobs/<job_id>', methods=['GET'])
+@login_required
+def get_import_job(job_id):
+    if not current_user.can_manage_activities():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    job = import_jobs.get(job_id)
+    if not job:
+        return jsonify({'error': 'Import job not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/import-jobs/<job_id>', methods=['DELETE'])
+@login_required
+def cancel_import_job(job_id):
+    if not current_user.can_manage_activities():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    job = import_jobs.cancel(job_id)
+    if not job:
+        return jsonify({'error': 'Import job not found'}), 404
+    return jsonify(job.to_dict())
+
+def build_activity(data):
+    """New Activity from a create/edit form payload.
+
+    A recurring activity is stored once as a series and expanded when read;
+    recurrence_end_date may be omitted for an open-ended series.
+    """
+    activity = Activity(
+        title=data['title'],
+        date=datetime.strptime(data['date'], '%Y-%m-%d'),
+        time=None if data.get('is_all_day') else data.get('time'),
+        end_date=datetime.strptime(data['end_date'], '%Y-%m-%d') if data.get('end_date') else None,
+        end_time=None if data.get('is_all_day') else data.get('end_time'),
+        is_all_day=data.get('is_all_day', False),
+        location_id=data.get('location_id'),
+        notes=data.get('notes', ''),
+        is_recurring=data.get('is_recurring', False),
+        recurrence_type=data.get('recurrence_type'),
+        recurrence_end_date=datetime.strptime(data['recurrence_end_date'], '%Y-%m-%d') if data.get('recurrence_end_date') else None,
+        is_series=bool(data.get('is_recurring') and data.get('recurrence_type')),
+        client_count=data.get('client_count')
+    )
+    if data.get('category_ids'):
+        activity.categories = Category.query.filter(Category.id.in_(data['category_ids'])).all()
+    return activity
+
+MAX_REPORTED_CONFLICTS = 50
+
+def load_bookings(location_ids, start, end, exclude_ids=()):
+    """Bookings (series expanded) of the given rooms overlapping [start, end], in one query."""
+    query = filter_activities_by_window(Activity.query, start=start, end=end).filter(db.or_(
+        Activity.location_id.in_(location_ids),
+        Activity.exceptions.any(ActivityException.location_id.in_(location_ids))
+    ))
+    if exclude_ids:
+        query = query.filter(Activity.id.not_in(exclude_ids))
+    activities = query.options(*activity_read_options()).all()
+    return [item for item in iter_activity_dicts(activities, start, end) if item['location_id'] in location_ids]
+
+def booking_conflicts(candidates, exclude_ids=()):
+    """Room conflicts of candidate bookings (activity dicts or import rows)
+    with the stored bookings other than `exclude_ids`, and with each other."""
+    candidates = [item for item in candidates if item.get('location_id') is not None]
+    if not candidates:
+        return []
+    start = min(parse_day(item['date']) for item in candidates)
+    end = max(parse_day(item.get('end_date') or item['date']) for item in candidates)
+    existing = load_bookings({item['location_id'] for item in candidates}, start, end, exclude_ids)
+    return find_conflicts(candidates, existing, timedelta(minutes=app.config['BOOKING_DEFAULT_MINUTES']))
+
+def activity_conflicts(activity_ids):
+    """Conflicts of flushed activities, every occurrence of a series up to
+    the recurrence horizon included."""
+    activities = Activity.query.options(*activity_read_options()).filter(Activity.id.in_(activity_ids)).all()
+    return booking_conflicts(list(iter_activity_dicts(activities)), exclude_ids=activity_ids)
+
+def conflict_response(conflicts):
+    return jsonify({
+        'error': 'Booking conflict',
+        'conflict_count': len(conflicts),
+        'conflicts': conflicts[:MAX_REPORTED_CONFLICTS]
+    }), 409
+
+def parse_time_arg(name, default):
+    """'HH:MM' query argument as an offset from midnight; '24:00' is allowed."""
+    value = request.args.get(name) or default
+    try:
+        hours, minutes = (int(part) for part in value.split(':'))
+    except ValueError:
+        raise ValueError(f'Invalid time: {value}')
+    if not (0 <= minutes < 60 and 0 <= hours <= 24) or (hours == 24 and minutes):
+        raise ValueError(f'Invalid time: {value}')
+    return timedelta(hours=hours, minutes=minutes)
+
+@app.route('/api/availability', methods=['GET'])
+@login_required
+def get_availability():
+    """Free slots per room: every gap of at least `duration` minutes between
+    `from` and `to` on each day from `start` to `end`.
+
+    `category_id` limits the search to rooms already hosting activities of
+    that category; `location_id` to a single room. All bookings of the range
+    are read in one query and swept per room and day.
+    """
+    try:
+        start = parse_date_arg('start')
+        end = parse_date_arg('end') or start
+        day_start = parse_time_arg('from', '00:00')
+        day_end = parse_time_arg('to', '24:00')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    duration = request.args.get('duration', 60, type=int)
+    if start is None:
+        return jsonify({'error': 'start is required'}), 400
+    if end < start or day_end <= day_start or duration <= 0:
+        return jsonify({'error': 'Empty search window'}), 400
+    if (end - start).days >= app.config['AVAILABILITY_MAX_DAYS']:
+        return jsonify({'error': f"Search at most {app.config['AVAILABILITY_MAX_DAYS']} days"}), 400
+
+    rooms = Location.query.order_by(Location.name)
+    if request.args.get('location_id', type=int):
+        rooms = rooms.filter(Location.id == request.args.get('location_id', type=int))
+    if request.args.get('category_id', type=int):
+        rooms = rooms.filter(Location.activities.any(
+            Activity.categories.any(Category.id == request.args.get('category_id', type=int))
+        ))
+    rooms = rooms.all()
+
+    index = BookingIndex(timedelta(minutes=app.config['BOOKING_DEFAULT_MINUTES']))
+    if rooms:
+        for item in load_bookings({room.id for room in rooms}, start, end):
+            index.add(item)
+
+    min_duration = timedelta(minutes=duration)
+    results = []
+    for room in rooms:
+        schedule = index.room(room.id)
+        slots = []
+        day = start
+        while day <= end:
+            for slot_start, slot_end in schedule.free_slots(day + day_start, day + day_end, min_duration):
+                slots.append({
+                    'start': slot_start.strftime('%Y-%m-%dT%H:%M'),
+                    'end': slot_end.strftime('%Y-%m-%dT%H:%M'),
+                    'minutes': int((slot_end - slot_start).total_seconds() // 60)
+                })
+            day += timedelta(days=1)
+        if slots:
+            results.append({'location_id': room.id, 'location': room.name, 'free_slots': slots})
+    return jsonify(results)
+
 @app.route('/api/activities', methods=['POST'])
 @login_required
 def create_activity():
@@ -308,63 +1030,193 @@ def create_activity():
         return jsonify({'error': 'Unauthorized'}), 403
     
     data = request.json
+    if data.get('is_recurring') and data.get('recurrence_type') and data['recurrence_type'] not in RECURRENCE_TYPES:
+        return jsonify({'error': 'Invalid recurrence type'}), 400
+
     try:
-        base_activity = Activity(
-            title=data['title'],
-            date=datetime.strptime(data['date'], '%Y-%m-%d'),
-            time=None if data.get('is_all_day') else data.get('time'),
-            end_date=datetime.strptime(data['end_date'], '%Y-%m-%d') if data.get('end_date') else None,
-            end_time=None if data.get('is_all_day') else data.get('end_time'),
-            is_all_day=data.get('is_all_day', False),
-            location_id=data.get('location_id'),
-            notes=data.get('notes', ''),
-            is_recurring=data.get('is_recurring', False),
-            recurrence_type=data.get('recurrence_type'),
-            recurrence_end_date=datetime.strptime(data['recurrence_end_date'], '%Y-%m-%d') if data.get('recurrence_end_date') else None
-        )
-        
-        if data.get('category_ids'):
-            categories = Category.query.filter(Category.id.in_(data['category_ids'])).all()
-            base_activity.categories = categories
-        
-        activities_to_create = [base_activity]
-        
-        if data.get('is_recurring') and data.get('recurrence_type') and data.get('recurrence_end_date'):
-            start_date = datetime.strptime(data['date'], '%Y-%m-%d')
-            end_date = datetime.strptime(data['recurrence_end_date'], '%Y-%m-%d')
-            
-            recurring_dates = generate_recurring_dates(start_date, data['recurrence_type'], end_date)
-            
-            for date in recurring_dates[1:]:
-                recurring_activity = Activity(
-                    title=data['title'],
-                    date=date,
-                    time=data.get('time'),
-                    end_date=date + (base_activity.end_date - base_activity.date) if base_activity.end_date else None,
-                    end_time=data.get('end_time'),
-                    is_all_day=data.get('is_all_day', False),
-                    location_id=data.get('location_id'),
-                    notes=data.get('notes', ''),
-                    is_recurring=True,
-                    recurrence_type=data.get('recurrence_type'),
-                    recurrence_end_date=end_date
-                )
-                recurring_activity.categories = categories if data.get('category_ids') else []
-                activities_to_create.append(recurring_activity)
-        
-        for activity in activities_to_create:
-            db.session.add(activity)
-        
+        activity = build_activity(data)
+        db.session.add(activity)
+        db.session.flush()
+        if not data.get('allow_conflicts'):
+            conflicts = activity_conflicts([activity.id])
+            if conflicts:
+                db.session.rollback()
+                return conflict_response(conflicts)
+        usage_rollups.invalidate(Activity.id == activity.id)
+        bump_data_version()
         db.session.commit()
         
-        # Comment out email notification as requested by manager
-        # EmailNotifier.notify_activity_created(base_activity, [current_user.email])
+        EmailNotifier.notify_activity_created(activity, [current_user.email])
             
-        return jsonify({'success': True, 'id': base_activity.id})
+        return jsonify({'success': True, 'id': activity.id})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+SERIES_SCOPES = ('occurrence', 'following', 'series')
+
+def record_deletions(condition):
+    """Leave a tombstone for each activity matching `condition`, about to be deleted."""
+    now = datetime.utcnow()
+    db.session.execute(delete(ActivityTombstone).where(
+        ActivityTombstone.deleted_at < now - timedelta(days=app.config['SYNC_TOMBSTONE_DAYS'])
+    ))
+    db.session.execute(insert(ActivityTombstone).from_select(
+        ['activity_id', 'deleted_at'],
+        select(Activity.id, db.literal(now, db.DateTime)).where(condition)
+    ))
+
+def touch_activities(condition):
+    """Bump updated_at of matching activities whose serialized form changed
+    through a related row (category, room) rather than their own columns."""
+    db.session.execute(
+        update(Activity).where(condition).values(updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+def delete_activities_where(condition):
+    """Delete matching activities and their dependent rows in set-based statements."""
+    # Resolved once: `condition` may filter on the category links deleted first
+    ids = db.session.execute(select(Activity.id).where(condition)).scalars().all()
+    record_deletions(Activity.id.in_(ids))
+    db.session.execute(delete(activity_categories).where(activity_categories.c.activity_id.in_(ids)))
+    db.session.execute(delete(ActivityException).where(ActivityException.activity_id.in_(ids)))
+    return db.session.execute(
+        delete(Activity).where(Activity.id.in_(ids)).execution_options(synchronize_session=False)
+    ).rowcount
+
+import_jobs.init_app(app, on_commit=bump_data_version, conflict_checker=booking_conflicts,
+                     delete_activities=delete_activities_where)
+
+def refresh_booking_bounds(condition):
+    """Recompute start_at/end_at of rows changed by a bulk UPDATE of their times."""
+    rows = db.session.execute(
+        select(Activity.id, Activity.date, Activity.time, Activity.end_date, Activity.end_time, Activity.is_all_day)
+        .where(condition)
+    ).all()
+    updates = []
+    for row in rows:
+        start_at, end_at = booking_bounds(row.date, row.time, row.end_date, row.end_time, row.is_all_day)
+        updates.append({'id': row.id, 'start_at': start_at, 'end_at': end_at})
+    if updates:
+        db.session.execute(update(Activity), updates)
+
+def shift_datetime(column, days):
+    """SQL expression moving a DateTime column by a whole number of days."""
+    if db.engine.dialect.name == 'sqlite':
+        # Same text layout SQLAlchemy stores, so comparisons keep working
+        return func.strftime('%Y-%m-%d %H:%M:%S.000000', column, f'{days:+d} days')
+    return column + timedelta(days=days)
+
+def parse_series_scope(activity):
+    """Validated (scope, occurrence_date) from the query string of a series edit/delete."""
+    scope = request.args.get('scope') or ('series' if activity.is_series else 'occurrence')
+    if scope not in SERIES_SCOPES:
+        raise ValueError('Invalid scope')
+    if scope != 'occurrence' and not (activity.is_series or activity.series_id):
+        raise ValueError('Activity is not part of a series')
+    if not activity.is_series or scope == 'series':
+        return scope, None
+
+    occurrence_date = parse_date_arg('occurrence_date')
+    if occurrence_date is None:
+        raise ValueError('occurrence_date is required')
+    occurrence = next(occurrence_dates(activity.date, activity.recurrence_type, occurrence_date,
+                                       occurrence_date + timedelta(days=1),
+                                       until=activity.recurrence_end_date), None)
+    if occurrence is None or occurrence.date() != occurrence_date.date():
+        raise ValueError('occurrence_date is not an occurrence of this series')
+    return scope, occurrence
+
+def materialized_series_filter(activity, scope):
+    # Recurring activities created before series rows existed: one row per
+    # occurrence, grouped by series_id.
+    condition = Activity.series_id == activity.series_id
+    if scope == 'following':
+        condition = db.and_(condition, Activity.date >= activity.date)
+    return condition
+
+def update_materialized_series(activity, scope, data):
+    """Apply an edit to this and following / all rows of a materialized series
+    with one UPDATE, and replace their categories with one DELETE + INSERT."""
+    # Fixed before the UPDATE, which may move rows out of a date condition
+    condition = Activity.id.in_(db.session.execute(
+        select(Activity.id).where(materialized_series_filter(activity, scope))
+    ).scalars().all())
+    values = {
+        'title': data['title'],
+        'is_all_day': data.get('is_all_day', False),
+        'time': None if data.get('is_all_day') else data.get('time'),
+        'end_time': None if data.get('is_all_day') else data.get('end_time'),
+        'location_id': data.get('location_id'),
+        'notes': data.get('notes', '')
+    }
+    # Moving the edited occurrence moves every targeted occurrence by as many days
+    delta = (datetime.strptime(data['date'], '%Y-%m-%d').date() - activity.date.date()).days
+    if delta:
+        values['date'] = shift_datetime(Activity.date, delta)
+        values['end_date'] = shift_datetime(Activity.end_date, delta)
+
+    result = db.session.execute(
+        update(Activity).where(condition).values(**values).execution_options(synchronize_session=False)
+    )
+    refresh_booking_bounds(condition)
+    if data.get('category_ids'):
+        target_ids = select(Activity.id).where(condition)
+        db.session.execute(delete(activity_categories).where(activity_categories.c.activity_id.in_(target_ids)))
+        db.session.execute(insert(activity_categories).from_select(
+            ['activity_id', 'category_id'],
+            select(Activity.id, Category.id)
+            .join(Category, Category.id.in_(data['category_ids']))
+            .where(condition)
+        ))
+    # The statements above bypass the session: reload the edited row when next read
+    db.session.expire(activity)
+    return result.rowcount
+
+def update_series_occurrences(series, occurrence, scope, data):
+    """Edit one occurrence (as an exception) or split the series at `occurrence`.
+
+    Returns the activities whose bookings changed.
+    """
+    new_date = datetime.strptime(data['date'], '%Y-%m-%d')
+    if scope == 'occurrence':
+        exception = ActivityException.query.filter_by(activity_id=series.id, occurrence_date=occurrence).first()
+        if exception is None:
+            exception = ActivityException(activity_id=series.id, occurrence_date=occurrence)
+            db.session.add(exception)
+        if new_date.date() == occurrence.date():
+            exception.is_cancelled = False
+            exception.title = data['title']
+            exception.time = None if data.get('is_all_day') else data.get('time')
+            exception.end_time = None if data.get('is_all_day') else data.get('end_time')
+            exception.location_id = data.get('location_id')
+            exception.notes = data.get('notes', '')
+            return [series]
+        # Moved to another day: drop it from the series and keep it standalone
+        exception.is_cancelled = True
+        standalone = build_activity(dict(data, is_recurring=False, recurrence_type=None, recurrence_end_date=None))
+        if not data.get('category_ids'):
+            standalone.categories = list(series.categories)
+        db.session.add(standalone)
+        return [standalone]
+
+    # This and following: end the current series the day before and start a
+    # new one carrying the edited fields and the later exceptions.
+    tail = build_activity(dict(data, is_recurring=True, recurrence_type=data.get('recurrence_type') or series.recurrence_type))
+    if not data.get('category_ids'):
+        tail.categories = list(series.categories)
+    db.session.add(tail)
+    db.session.flush()
+    later_exceptions = db.and_(ActivityException.activity_id == series.id,
+                               ActivityException.occurrence_date >= occurrence)
+    if new_date.date() == occurrence.date():
+        db.session.execute(update(ActivityException).where(later_exceptions).values(activity_id=tail.id))
+    else:
+        db.session.execute(delete(ActivityException).where(later_exceptions))
+    series.recurrence_end_date = occurrence - timedelta(days=1)
+    return [tail]
+
 @app.route('/api/activities/<int:activity_id>', methods=['PUT'])
 @login_required
 def update_activity(activity_id):
@@ -374,7 +1226,66 @@ def update_activity(activity_id):
     activity = Activity.query.get_or_404(activity_id)
     data = request.json
     
+    if data.get('is_recurring') and data.get('recurrence_type') not in RECURRENCE_TYPES:
+        return jsonify({'error': 'Invalid recurrence type'}), 400
+    try:
+        scope, occurrence = parse_series_scope(activity)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    # Editing the first occurrence "and following" is the same as editing the series
+    if occurrence and (scope == 'occurrence' or occurrence != activity.date):
+        try:
+            usage_rollups.invalidate(Activity.id == activity.id)
+            changed = update_series_occurrences(activity, occurrence, scope, data)
+            db.session.flush()
+            changed_ids = [changed_activity.id for changed_activity in changed]
+            if not data.get('allow_conflicts'):
+                conflicts = activity_conflicts(changed_ids)
+                if conflicts:
+                    db.session.rollback()
+                    return conflict_response(conflicts)
+            usage_rollups.invalidate(Activity.id.in_(changed_ids))
+            bump_data_version()
+            db.session.commit()
+
+            edited = changed[0]
+            if edited is activity:
+                exception = ActivityException.query.filter_by(activity_id=activity.id, occurrence_date=occurrence).first()
+                EmailNotifier.notify_series_updated(activity.id, activity, scope, occurrence, [current_user.email],
+                                                    exception=exception)
+            else:
+                EmailNotifier.notify_series_updated(activity.id, edited, scope, edited.date, [current_user.email])
+            return jsonify({'success': True, 'count': len(changed)})
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 500
+
+    if activity.series_id and scope != 'occurrence':
+        try:
+            changed_ids = db.session.execute(
+                select(Activity.id).where(materialized_series_filter(activity, scope))
+            ).scalars().all()
+            usage_rollups.invalidate(Activity.id.in_(changed_ids))
+            count = update_materialized_series(activity, scope, data)
+            if not data.get('allow_conflicts'):
+                conflicts = activity_conflicts(changed_ids)
+                if conflicts:
+                    db.session.rollback()
+                    return conflict_response(conflicts)
+            usage_rollups.invalidate(Activity.id.in_(changed_ids))
+            bump_data_version()
+            db.session.commit()
+            EmailNotifier.notify_series_updated(activity.series_id, activity, scope, activity.date,
+                                                [current_user.email])
+            return jsonify({'success': True, 'count': count})
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 500
+
     try:
+        usage_rollups.invalidate(Activity.id == activity.id)
+        was_recurring = activity.is_recurring
         activity.title = data['title']
         activity.date = datetime.strptime(data['date'], '%Y-%m-%d')
         activity.is_all_day = data.get('is_all_day', False)
@@ -383,18 +1294,31 @@ def update_activity(activity_id):
         activity.end_time = None if data.get('is_all_day') else data.get('end_time')
         activity.location_id = data.get('location_id')
         activity.notes = data.get('notes', '')
+        if 'client_count' in data:
+            activity.client_count = data['client_count']
         activity.is_recurring = data.get('is_recurring', False)
         activity.recurrence_type = data.get('recurrence_type')
         activity.recurrence_end_date = datetime.strptime(data['recurrence_end_date'], '%Y-%m-%d') if data.get('recurrence_end_date') else None
+        # Rows materialized before series existed keep is_series off so their
+        # siblings are not duplicated by expansion.
+        if activity.is_series or not was_recurring:
+            activity.is_series = bool(activity.is_recurring and activity.recurrence_type)
         
         if data.get('category_ids'):
             categories = Category.query.filter(Category.id.in_(data['category_ids'])).all()
             activity.categories = categories
-        
+
+        db.session.flush()
+        if not data.get('allow_conflicts'):
+            conflicts = activity_conflicts([activity.id])
+            if conflicts:
+                db.session.rollback()
+                return conflict_response(conflicts)
+        usage_rollups.invalidate(Activity.id == activity.id)
+        bump_data_version()
         db.session.commit()
         
-        # Comment out email notification as requested by manager
-        # EmailNotifier.notify_activity_updated(activity, [current_user.email])
+        EmailNotifier.notify_activity_updated(activity, [current_user.email])
             
         return jsonify({'success': True})
     except Exception as e:
@@ -409,9 +1333,47 @@ def delete_activity(activity_id):
     
     activity = Activity.query.get_or_404(activity_id)
     try:
-        db.session.delete(activity)
+        scope, occurrence = parse_series_scope(activity)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        count = 1
+        deleted = None
+        series_deleted = None
+        if activity.series_id and scope != 'occurrence':
+            usage_rollups.invalidate(materialized_series_filter(activity, scope))
+        else:
+            usage_rollups.invalidate(Activity.id == activity.id)
+        if occurrence and scope == 'occurrence':
+            exception = ActivityException.query.filter_by(activity_id=activity.id, occurrence_date=occurrence).first()
+            if exception is None:
+                db.session.add(ActivityException(activity_id=activity.id, occurrence_date=occurrence, is_cancelled=True))
+            else:
+                exception.is_cancelled = True
+            series_deleted = (activity.id, activity.title, scope, occurrence)
+        elif occurrence and occurrence > activity.date:
+            # This and following: the series simply ends the day before
+            activity.recurrence_end_date = occurrence - timedelta(days=1)
+            db.session.execute(delete(ActivityException).where(
+                ActivityException.activity_id == activity.id,
+                ActivityException.occurrence_date >= occurrence
+            ))
+            series_deleted = (activity.id, activity.title, scope, occurrence)
+        elif activity.series_id and scope != 'occurrence':
+            series_deleted = (activity.series_id, activity.title, scope, activity.date)
+            count = delete_activities_where(materialized_series_filter(activity, scope))
+        else:
+            deleted = (activity.id, activity.title, activity.date.strftime('%Y-%m-%d'))
+            record_deletions(Activity.id == activity.id)
+            db.session.delete(activity)
+        bump_data_version()
         db.session.commit()
-        return jsonify({'success': True})
+        if deleted:
+            EmailNotifier.notify_activity_deleted(*deleted, [current_user.email])
+        if series_deleted:
+            EmailNotifier.notify_series_deleted(*series_deleted, [current_user.email])
+        return jsonify({'success': True, 'count': count})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -427,23 +1389,136 @@ def bulk_delete_activities():
         return jsonify({'error': 'No activity IDs provided'}), 400
     
     try:
-        # Get all activities to delete
-        activities = Activity.query.filter(Activity.id.in_(data['ids'])).all()
-        
-        # Delete all activities in a single transaction
-        for activity in activities:
-            db.session.delete(activity)
-        
+        usage_rollups.invalidate(Activity.id.in_(data['ids']))
+        count = delete_activities_where(Activity.id.in_(data['ids']))
+        bump_data_version()
         db.session.commit()
         return jsonify({
             'success': True,
-            'count': len(activities),
-            'message': f'Successfully deleted {len(activities)} activities'
+            'count': count,
+            'message': f'Successfully deleted {count} activities'
         })
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
+
+BULK_ACTIONS = ('delete', 'shift', 'move', 'add_category', 'remove_category')
+
+def bulk_target_condition(data):
+    """(WHERE clause selecting the activities named by `ids` or matched by
+    `filter`, WHERE clause of the series rows the filter leaves out or None).
+
+    A series row stands for all its occurrences, so a date filter only takes
+    the series whose occurrences all start within it; changing one reaching
+    past the window would change occurrences outside it too.
+    """
+    if data.get('ids'):
+        return Activity.id.in_(data['ids']), None
+    criteria = data.get('filter') or {}
+    if not any(criteria.get(key) for key in ('start', 'end', 'location_id', 'category_id')):
+        raise ValueError('Provide ids or at least one filter criterion')
+    parse = lambda value: datetime.strptime(value, '%Y-%m-%d') if value else None
+    start, end = parse(criteria.get('start')), parse(criteria.get('end'))
+    matching = filter_activities_by_window(
+        select(Activity.id),
+        start=start,
+        end=end,
+        location_id=criteria.get('location_id'),
+        category_id=criteria.get('category_id')
+    )
+    if not (start or end):
+        return Activity.id.in_(matching), None
+    within = [Activity.is_series.is_(True)]
+    if start:
+        within.append(Activity.date >= start)
+    if end:
+        within += [Activity.recurrence_end_date.isnot(None), Activity.recurrence_end_date <= end]
+    whole = db.or_(Activity.is_series.is_(False), db.and_(*within))
+    return Activity.id.in_(matching.where(whole)), Activity.id.in_(matching.where(db.not_(whole)))
+
+@app.route('/api/activities/bulk', methods=['POST'])
+@login_required
+def bulk_mutate_activities():
+    """Delete, shift, move or (un)categorize many activities in single statements.
+
+    Series rows are changed as a whole; those a date filter only partly
+    covers are left alone and listed in `skipped_series`.
+    """
+    if not current_user.can_manage_activities():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    data = request.json or {}
+    action = data.get('action')
+    if action not in BULK_ACTIONS:
+        return jsonify({'error': f'action must be one of {", ".join(BULK_ACTIONS)}'}), 400
+    try:
+        condition, partial_series = bulk_target_condition(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if action == 'shift' and not isinstance(data.get('days'), int):
+        return jsonify({'error': 'days must be an integer'}), 400
+    if action == 'move' and data.get('location_id') is not None and not db.session.get(Location, data['location_id']):
+        return jsonify({'error': 'Location not found'}), 404
+    if action in ('add_category', 'remove_category') and not db.session.get(Category, data.get('category_id') or 0):
+        return jsonify({'error': 'Category not found'}), 404
+
+    try:
+        # Fixed before any statement, which may move rows out of a date filter
+        # or remove the category links a filter matches on
+        target_ids = db.session.execute(select(Activity.id).where(condition)).scalars().all()
+        condition = Activity.id.in_(target_ids)
+        skipped_series = [] if partial_series is None else \
+            db.session.execute(select(Activity.id).where(partial_series)).scalars().all()
+        # Every action changes the bookings, rooms or categories counted in
+        # the months these activities cover
+        usage_rollups.invalidate(condition)
+        if action == 'delete':
+            count = delete_activities_where(condition)
+        elif action == 'shift':
+            days = data['days']
+            count = db.session.execute(update(Activity).where(condition).values(
+                date=shift_datetime(Activity.date, days),
+                end_date=shift_datetime(Activity.end_date, days),
+                start_at=shift_datetime(Activity.start_at, days),
+                end_at=shift_datetime(Activity.end_at, days),
+                recurrence_end_date=shift_datetime(Activity.recurrence_end_date, days)
+            ).execution_options(synchronize_session=False)).rowcount
+            db.session.execute(update(ActivityException).where(
+                ActivityException.activity_id.in_(target_ids)
+            ).values(occurrence_date=shift_datetime(ActivityException.occurrence_date, days)))
+            usage_rollups.invalidate(condition)
+        elif action == 'move':
+            count = db.session.execute(update(Activity).where(condition).values(
+                location_id=data.get('location_id')
+            ).execution_options(synchronize_session=False)).rowcount
+        elif action == 'add_category':
+            already_linked = select(activity_categories.c.activity_id).where(
+                activity_categories.c.category_id == data['category_id']
+            )
+            touch_activities(db.and_(condition, Activity.id.not_in(already_linked)))
+            count = db.session.execute(insert(activity_categories).from_select(
+                ['activity_id', 'category_id'],
+                select(Activity.id, db.literal(data['category_id'])).where(
+                    condition, Activity.id.not_in(already_linked)
+                )
+            )).rowcount
+        else:
+            touch_activities(db.and_(condition, Activity.categories.any(Category.id == data['category_id'])))
+            count = db.session.execute(delete(activity_categories).where(
+                activity_categories.c.category_id == data['category_id'],
+                activity_categories.c.activity_id.in_(target_ids)
+            )).rowcount
+
+        bump_data_version()
+        db.session.commit()
+        return jsonify({'success': True, 'action': action, 'count': count, 'skipped_series': skipped_series})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/categories', methods=['GET'])
+@versioned
 def get_categories():
     categories = Category.query.all()
     return jsonify([{
@@ -482,6 +1557,7 @@ def create_category():
     db.session.add(category)
     
     try:
+        bump_data_version()
         db.session.commit()
         return jsonify({'success': True, 'id': category.id})
     except Exception as e:
@@ -511,6 +1587,8 @@ def update_category(category_id):
     try:
         category.name = data['name']
         category.color = data.get('color', '#6f42c1')
+        touch_activities(Activity.categories.any(Category.id == category_id))
+        bump_data_version()
         db.session.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -525,7 +1603,10 @@ def delete_category(category_id):
     
     category = Category.query.get_or_404(category_id)
     try:
+        usage_rollups.forget_category(category_id)
+        touch_activities(Activity.categories.any(Category.id == category_id))
         db.session.delete(category)
+        bump_data_version()
         db.session.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -534,6 +1615,7 @@ def delete_category(category_id):
 
 @app.route('/api/locations', methods=['GET'])
 @login_required
+@versioned
 def get_locations():
     locations = Location.query.all()
     return jsonify([{
@@ -564,6 +1646,7 @@ def create_location():
     db.session.add(location)
     
     try:
+        bump_data_version()
         db.session.commit()
         return jsonify({'success': True, 'id': location.id})
     except Exception as e:
@@ -588,6 +1671,11 @@ def update_location(location_id):
     location.name = data['name']
     
     try:
+        touch_activities(db.or_(
+            Activity.location_id == location_id,
+            Activity.exceptions.any(ActivityException.location_id == location_id)
+        ))
+        bump_data_version()
         db.session.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -607,12 +1695,29 @@ def delete_location(location_id):
     
     try:
         db.session.delete(location)
+        bump_data_version()
         db.session.commit()
         return jsonify({'success': True})
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/digest', methods=['GET', 'PUT'])
+@login_required
+def digest_subscription():
+    """The current user's digest email subscription: 'daily', 'weekly' or null."""
+    if request.method == 'PUT':
+        frequency = (request.get_json(silent=True) or {}).get('digest_frequency')
+        if frequency is not None and frequency not in DIGEST_FREQUENCIES:
+            return jsonify({'error': f'digest_frequency must be one of {", ".join(DIGEST_FREQUENCIES)} or null'}), 400
+        try:
+            current_user.digest_frequency = frequency
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 500
+    return jsonify({'digest_frequency': current_user.digest_frequency})
+
 @app.route('/api/users')
 @login_required
 def get_users():
@@ -743,6 +1848,7 @@ def init_db():
             role='admin'
         )
         db.session.add(admin)
+        db.session.add(DataVersion(name=CALENDAR_VERSION, version=0))
         
         # Create some sample categories with different colors
         categories_data = [
@@ -817,26 +1923,151 @@ def init_db():
             
             db.session.commit()
 
-def generate_recurring_dates(start_date, recurrence_type, end_date):
-    dates = []
-    current_date = start_date
-    
-    while current_date <= end_date:
-        dates.append(current_date)
-        
-        if recurrence_type == 'daily':
-            current_date = current_date + timedelta(days=1)
-        elif recurrence_type == 'weekly':
-            current_date = current_date + timedelta(weeks=1)
-        elif recurrence_type == 'monthly':
-            year = current_date.year + ((current_date.month + 1) // 12)
-            month = ((current_date.month + 1) % 12) or 12
-            day = min(current_date.day, [31, 29 if year % 4 == 0 and (year % 100 != 0 or year % 400 == 0) else 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31][month - 1])
-            current_date = current_date.replace(year=year, month=month, day=day)
-        elif recurrence_type == 'annually':
-            current_date = current_date.replace(year=current_date.year + 1)
-    
-    return dates
+# Set once migrate_db has run in this process
+schema_migrated = False
+schema_migration_lock = threading.Lock()
+
+def migrate_db():
+    """Apply schema additions to an existing database without dropping data."""
+    global schema_migrated
+    columns = {
+        'activity': [
+            ('is_series', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+            ('series_id', 'INTEGER'),
+            ('external_key', 'VARCHAR(255)'),
+            ('content_hash', 'VARCHAR(40)'),
+            ('start_at', 'TIMESTAMP'),
+            ('end_at', 'TIMESTAMP'),
+            ('client_count', 'INTEGER'),
+        ],
+        'user': [
+            ('share_token', 'VARCHAR(32)'),
+            ('digest_frequency', 'VARCHAR(10)'),
+            ('last_digest_at', 'TIMESTAMP'),
+        ],
+    }
+    statements = [
+        'CREATE INDEX IF NOT EXISTS ix_activity_date ON activity (date)',
+        'CREATE INDEX IF NOT EXISTS ix_activity_series_id ON activity (series_id)',
+        'CREATE INDEX IF NOT EXISTS ix_activity_external_key ON activity (external_key)',
+        'CREATE INDEX IF NOT EXISTS ix_activity_start_at ON activity (start_at)',
+        'CREATE INDEX IF NOT EXISTS ix_activity_end_at ON activity (end_at)',
+        'CREATE INDEX IF NOT EXISTS ix_activity_start_id ON activity (start_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_activity_location_start_end ON activity (location_id, start_at, end_at)',
+        'CREATE INDEX IF NOT EXISTS ix_activity_updated_at ON activity (updated_at)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_user_share_token ON "user" (share_token)',
+        'CREATE INDEX IF NOT EXISTS ix_user_digest_frequency ON "user" (digest_frequency)',
+        # Superseded by the start_at/end_at indexes
+        'DROP INDEX IF EXISTS ix_activity_end_date',
+        'DROP INDEX IF EXISTS ix_activity_date_id',
+        'DROP INDEX IF EXISTS ix_activity_location_date',
+    ]
+    with app.app_context():
+        db.create_all()
+        inspector = db.inspect(db.engine)
+        for table, table_columns in columns.items():
+            existing = {column['name'] for column in inspector.get_columns(table)}
+            for name, definition in table_columns:
+                if name not in existing:
+                    # "user" is a reserved word in PostgreSQL
+                    quoted = db.engine.dialect.identifier_preparer.quote(table)
+                    db.session.execute(text(f'ALTER TABLE {quoted} ADD COLUMN {name} {definition}'))
+        for statement in statements:
+            db.session.execute(text(statement))
+        if not db.session.get(DataVersion, CALENDAR_VERSION):
+            db.session.add(DataVersion(name=CALENDAR_VERSION, version=0))
+        # Rows without updated_at would never reach delta sync clients
+        db.session.execute(update(Activity).where(Activity.updated_at.is_(None)).values(
+            updated_at=func.coalesce(Activity.created_at, datetime.utcnow())
+        ).execution_options(synchronize_session=False))
+        backfill_series_ids()
+        backfill_external_keys()
+        search.install()
+        db.session.commit()
+        backfill_booking_bounds()
+    schema_migrated = True
+
+@app.before_request
+def ensure_schema_migrated():
+    # However the app is served (app.py, main.py, a WSGI server), the first
+    # request migrates the database before anything queries the new columns
+    if not schema_migrated:
+        with schema_migration_lock:
+            if not schema_migrated:
+                migrate_db()
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """Apply schema additions to the configured database."""
+    migrate_db()
+
+def backfill_series_ids():
+    """Group recurring rows materialized one per occurrence into series.
+
+    Rows created together share every copied field, got consecutive ids and
+    dates one recurrence step apart. A row joins the last series with the same
+    (title, rule, end, location, times) only when its id and date both follow
+    on from that series' last row, a deleted occurrence skipping one step of
+    each; the series_id is the id of the series' first row. Distinct series
+    sharing those fields stay apart, as does an occurrence moved off its date.
+    """
+    rows = db.session.execute(
+        select(Activity.id, Activity.date, Activity.title, Activity.recurrence_type, Activity.recurrence_end_date,
+               Activity.location_id, Activity.time, Activity.end_time)
+        .where(Activity.is_recurring.is_(True), Activity.is_series.is_(False), Activity.series_id.is_(None))
+        .order_by(Activity.id)
+    ).all()
+    last_rows = {}
+    updates = []
+    for row in rows:
+        key = tuple(row[2:])
+        series_id = row.id
+        if key in last_rows and row.recurrence_type in RECURRENCE_TYPES:
+            last_series_id, last_id, last_date = last_rows[key]
+            if row.date == nth_occurrence(last_date, row.recurrence_type, row.id - last_id):
+                series_id = last_series_id
+        last_rows[key] = (series_id, row.id, row.date)
+        updates.append({'id': row.id, 'series_id': series_id})
+    if updates:
+        db.session.execute(update(Activity), updates)
+
+def backfill_external_keys():
+    """Key activities imported before external keys existed so the next
+    upsert import updates them instead of inserting duplicates.
+
+    Those imports stored the contract number in `notes` and wrote single-day
+    rows without categories; activities entered by hand, whose notes are free
+    text, are left unkeyed. Leaving content_hash empty makes the next import
+    rewrite each matched row once.
+    """
+    rows = db.session.execute(
+        select(Activity.id, Activity.notes, Activity.date, Location.name, Activity.time, Activity.title)
+        .outerjoin(Location, Activity.location_id == Location.id)
+        .where(Activity.external_key.is_(None), Activity.is_recurring.is_not(True),
+               Activity.end_date.is_(None), ~Activity.categories.any(),
+               Activity.notes.is_not(None), Activity.notes != '')
+    ).all()
+    updates = [
+        {'id': row.id, 'external_key': external_key(row.notes.strip(), row.date, row.name or '', row.time, row.title)}
+        for row in rows if CONTRACT_PATTERN.match(row.notes.strip())
+    ]
+    if updates:
+        db.session.execute(update(Activity), updates)
+
+def backfill_booking_bounds(batch_size=5000):
+    """Fill start_at/end_at of rows written before the columns existed,
+    committing batch by batch so large tables are not locked in one transaction."""
+    last_id = 0
+    while True:
+        batch = db.session.execute(
+            select(Activity.id).where(Activity.start_at.is_(None), Activity.id > last_id)
+            .order_by(Activity.id).limit(batch_size)
+        ).scalars().all()
+        if not batch:
+            return
+        refresh_booking_bounds(Activity.id.in_(batch))
+        db.session.commit()
+        last_id = batch[-1]
 
 if __name__ == '__main__':
     with app.app_context():
@@ -848,5 +2079,11 @@ if __name__ == '__main__':
             print('Failed to connect to the database!')
             print(e)
             exit(1)
-        
+
+    migrate_db()
+    if app.config['ACTIVITY_CACHE_WARM']:
+        warm_activity_cache()
+    # Only in the process serving requests, not in the reloader's watcher
+    if app.config['EMAIL_DIGESTS'] and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        digests.start()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
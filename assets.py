@@ -0,0 +1,86 @@
+import json
+import mimetypes
+import os
+
+from flask import request, send_from_directory
+
+from build_assets import DIST_NAME, MANIFEST_NAME
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Preferred first when a client accepts several
+ENCODING_SUFFIXES = (('br', 'br'), ('gzip', 'gz'))
+
+
+class AssetManifest:
+    """Serves the fingerprinted build of static/ made by build_assets.py.
+
+    url_for('static', filename=...) is rewritten to the hashed copy listed in
+    static/dist/manifest.json, which is served with an immutable one-year
+    cache lifetime and as its precompressed .br/.gz variant when the client
+    accepts one. Files missing from the manifest, or edited since the build,
+    keep their plain URL and Flask's default handling.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._manifest = (None, {})  # (mtime, parsed manifest)
+
+    def init_app(self, app):
+        self.app = app
+        app.url_defaults(self.fingerprint_url)
+        self._send_static = app.view_functions['static']
+        app.view_functions['static'] = self.serve
+
+    @property
+    def path(self):
+        return os.path.join(self.app.static_folder, DIST_NAME, MANIFEST_NAME)
+
+    def manifest(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return {}
+        if self._manifest[0] != mtime:
+            with open(self.path, 'rb') as manifest_file:
+                self._manifest = (mtime, json.load(manifest_file))
+        return self._manifest[1]
+
+    def built_entry(self, filename):
+        entry = self.manifest().get(filename)
+        if entry is None:
+            return None
+        try:
+            source = os.stat(os.path.join(self.app.static_folder, filename))
+        except FileNotFoundError:
+            return None
+        if source.st_size != entry['size'] or source.st_mtime != entry['mtime']:
+            return None
+        return entry
+
+    def fingerprint_url(self, endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            entry = self.built_entry(values['filename'])
+            if entry:
+                values['filename'] = entry['file']
+
+    def serve(self, filename):
+        if not filename.startswith(DIST_NAME + '/'):
+            return self._send_static(filename=filename)
+
+        mimetype = mimetypes.guess_type(filename)[0]
+        response = None
+        for encoding, suffix in ENCODING_SUFFIXES:
+            if encoding in request.accept_encodings and \
+                    os.path.exists(os.path.join(self.app.static_folder, f'{filename}.{suffix}')):
+                response = send_from_directory(self.app.static_folder, f'{filename}.{suffix}',
+                                               mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+                response.content_encoding = encoding
+                break
+        if response is None:
+            response = send_from_directory(self.app.static_folder, filename, max_age=IMMUTABLE_MAX_AGE)
+        response.cache_control.immutable = True
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+assets = AssetManifest()
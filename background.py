@@ -0,0 +1,20 @@
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.schedulers.background import BackgroundScheduler
+
+# One scheduler per process for all background work. CSV imports get their
+# own pool so a long import never delays the short maintenance jobs.
+scheduler = BackgroundScheduler(job_defaults={'misfire_grace_time': None, 'coalesce': True})
+
+
+def init_app(app):
+    scheduler.configure(executors={
+        'default': ThreadPoolExecutor(app.config.get('BACKGROUND_WORKERS', 2)),
+        'imports': ThreadPoolExecutor(app.config.get('IMPORT_WORKERS', 2))
+    })
+
+
+def ensure_started():
+    """Start the scheduler on first use, so processes that never queue work
+    (such as the reloader's watcher) do not spin up its threads."""
+    if not scheduler.running:
+        scheduler.start()
@@ -0,0 +1,162 @@
+import re
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+# Room booking intervals built from the activity dicts served by /api/activities
+# (single activities and expanded series occurrences alike).
+
+
+CLOCK_PATTERN = re.compile(r'^\s*(\d{1,2})[:hH](\d{2})')
+
+
+def parse_day(value):
+    return value if isinstance(value, datetime) else datetime.strptime(value, '%Y-%m-%d')
+
+
+def parse_clock(value):
+    """'HH:MM' (or the exports' 'HHhMM') as an offset from midnight, None when
+    empty or unreadable; '24:00' is midnight of the next day."""
+    match = CLOCK_PATTERN.match(value or '')
+    if not match:
+        return None
+    return timedelta(hours=int(match.group(1)), minutes=int(match.group(2)))
+
+
+def booking_bounds(date, time, end_date, end_time, is_all_day):
+    """(start_at, end_at) stored for an activity (the first occurrence of a series).
+
+    All-day activities, or ones without a start time, span their days up to
+    the next midnight; a missing or earlier end time gives end_at == start_at.
+    """
+    first_day = parse_day(date).replace(hour=0, minute=0, second=0, microsecond=0)
+    last_day = parse_day(end_date).replace(hour=0, minute=0, second=0, microsecond=0) if end_date else first_day
+    start_offset = None if is_all_day else parse_clock(time)
+    if start_offset is None:
+        return first_day, last_day + timedelta(days=1)
+    start = first_day + start_offset
+    end_offset = parse_clock(end_time)
+    end = last_day + end_offset if end_offset is not None else start
+    return start, max(start, end)
+
+
+def booking_interval(item, default_duration):
+    """[start, end) a booking holds its room; one without a (valid) end time
+    is assumed to last `default_duration`."""
+    start, end = booking_bounds(item['date'], item.get('time'), item.get('end_date'),
+                                item.get('end_time'), item.get('is_all_day'))
+    return start, end if end > start else start + default_duration
+
+
+def booking_summary(item):
+    summary = {
+        'id': item.get('id'),
+        'series_id': item.get('series_id'),
+        'occurrence_date': item.get('occurrence_date'),
+        'title': item['title'],
+        'date': parse_day(item['date']).strftime('%Y-%m-%d'),
+        'time': item.get('time'),
+        'end_time': item.get('end_time'),
+        'location_id': item['location_id'],
+        'location': item.get('location')
+    }
+    if 'line' in item:
+        # Import rows are identified by their line in the uploaded file
+        summary['line'] = item['line']
+    return summary
+
+
+class RoomSchedule:
+    """Bookings of one room sorted by start, with a running maximum of end
+    times so an overlap lookup bisects to the candidates and stops scanning
+    back as soon as no earlier booking can still be running."""
+
+    def __init__(self):
+        self.bookings = []  # (start, end, item)
+        self._starts = None
+        self._max_ends = None
+
+    def add(self, start, end, item):
+        self.bookings.append((start, end, item))
+        self._starts = None
+
+    def _index(self):
+        if self._starts is None:
+            self.bookings.sort(key=lambda booking: (booking[0], booking[1]))
+            self._starts = [booking[0] for booking in self.bookings]
+            self._max_ends = []
+            running = None
+            for _, end, _ in self.bookings:
+                running = end if running is None or end > running else running
+                self._max_ends.append(running)
+
+    def overlapping(self, start, end):
+        self._index()
+        found = []
+        position = bisect_left(self._starts, end) - 1
+        while position >= 0 and self._max_ends[position] > start:
+            booking_start, booking_end, item = self.bookings[position]
+            if booking_end > start:
+                found.append((booking_start, booking_end, item))
+            position -= 1
+        found.reverse()
+        return found
+
+    def free_slots(self, start, end, min_duration):
+        """Gaps of at least `min_duration` in [start, end) not covered by a booking."""
+        slots = []
+        cursor = start
+        for booking_start, booking_end, _ in self.overlapping(start, end):
+            if booking_start - cursor >= min_duration:
+                slots.append((cursor, booking_start))
+            cursor = max(cursor, booking_end)
+        if end - cursor >= min_duration:
+            slots.append((cursor, end))
+        return slots
+
+
+class BookingIndex:
+    def __init__(self, default_duration=timedelta(hours=1)):
+        self.default_duration = default_duration
+        self.rooms = {}
+
+    def add(self, item):
+        if item.get('location_id') is None:
+            return
+        start, end = booking_interval(item, self.default_duration)
+        self.rooms.setdefault(item['location_id'], RoomSchedule()).add(start, end, item)
+
+    def room(self, location_id):
+        return self.rooms.get(location_id) or RoomSchedule()
+
+    def overlapping(self, item):
+        room = self.rooms.get(item.get('location_id'))
+        if room is None:
+            return []
+        start, end = booking_interval(item, self.default_duration)
+        return [other for _, _, other in room.overlapping(start, end)]
+
+
+def find_conflicts(candidates, existing, default_duration=timedelta(hours=1)):
+    """Conflicts of `candidates` with `existing` bookings and with each other.
+
+    Both sides are indexed once, so checking a whole batch costs one sort
+    plus a bisect per candidate. Occurrences of the same activity (same
+    `id`) never conflict with each other. Returns
+    [{'activity': summary, 'conflicts_with': [summaries]}].
+    """
+    candidates = [item for item in candidates if item.get('location_id') is not None]
+    existing_index = BookingIndex(default_duration)
+    for item in existing:
+        existing_index.add(item)
+    candidate_index = BookingIndex(default_duration)
+    for item in candidates:
+        candidate_index.add(item)
+
+    conflicts = []
+    for item in candidates:
+        others = [other for other in existing_index.overlapping(item) + candidate_index.overlapping(item)
+                  if other is not item and (item.get('id') is None or other.get('id') != item.get('id'))]
+        if others:
+            conflicts.append({'activity': booking_summary(item),
+                              'conflicts_with': [booking_summary(other) for other in others]})
+    return conflicts
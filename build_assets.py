@@ -0,0 +1,111 @@
+"""Build fingerprinted copies of static/ into static/dist/.
+
+Each asset is minified (JS/CSS) or optimized (PNG), written as
+`dist/<path>.<content hash>.<ext>` with .gz and .br variants next to it,
+and listed in dist/manifest.json, which assets.py uses to rewrite
+url_for('static') and serve the compressed files.
+
+    python build_assets.py
+"""
+import gzip
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+
+import brotli
+import rcssmin
+import rjsmin
+from PIL import Image
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_NAME = 'dist'
+MANIFEST_NAME = 'manifest.json'
+ASSET_EXTENSIONS = ('.js', '.css', '.png', '.svg')
+COMPRESSED_EXTENSIONS = ('.js', '.css', '.svg')
+HASH_LENGTH = 12
+
+
+def minify_css(text):
+    return rcssmin.cssmin(text)
+
+
+def minify_js(text):
+    return rjsmin.jsmin(text)
+
+
+def optimize_png(data):
+    output = io.BytesIO()
+    Image.open(io.BytesIO(data)).save(output, format='PNG', optimize=True)
+    return output.getvalue() if output.tell() < len(data) else data
+
+
+def transform(path, data):
+    extension = os.path.splitext(path)[1]
+    if extension == '.css':
+        return minify_css(data.decode('utf-8')).encode('utf-8')
+    if extension == '.js':
+        return minify_js(data.decode('utf-8')).encode('utf-8')
+    if extension == '.png':
+        return optimize_png(data)
+    return data
+
+
+def write_file(path, body):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(handle, 'wb') as output:
+        output.write(body)
+    os.replace(temp_path, path)
+
+
+def source_files(static_dir):
+    for directory, subdirectories, filenames in os.walk(static_dir):
+        if directory == static_dir:
+            subdirectories[:] = [name for name in subdirectories if name != DIST_NAME]
+        for filename in sorted(filenames):
+            if filename.endswith(ASSET_EXTENSIONS):
+                path = os.path.join(directory, filename)
+                yield os.path.relpath(path, static_dir).replace(os.sep, '/'), path
+
+
+def build(static_dir=STATIC_DIR):
+    dist_dir = os.path.join(static_dir, DIST_NAME)
+    manifest = {}
+    written = {MANIFEST_NAME}
+    for name, path in source_files(static_dir):
+        with open(path, 'rb') as source:
+            body = transform(name, source.read())
+        stem, extension = os.path.splitext(name)
+        built = f'{stem}.{hashlib.sha256(body).hexdigest()[:HASH_LENGTH]}{extension}'
+        variants = {built: body}
+        if extension in COMPRESSED_EXTENSIONS:
+            variants[built + '.gz'] = gzip.compress(body, compresslevel=9, mtime=0)
+            variants[built + '.br'] = brotli.compress(body, quality=11)
+        for variant, variant_body in variants.items():
+            if not os.path.exists(os.path.join(dist_dir, variant)):
+                write_file(os.path.join(dist_dir, variant), variant_body)
+            written.add(variant)
+
+        stat = os.stat(path)
+        # The source's size and mtime let the app fall back to the plain file
+        # once it is edited and the build is out of date
+        manifest[name] = {'file': f'{DIST_NAME}/{built}', 'size': stat.st_size, 'mtime': stat.st_mtime,
+                          'encodings': sorted(variant.rsplit('.', 1)[1] for variant in variants if variant != built)}
+        print(f'{name}: {stat.st_size} -> {len(body)} bytes'
+              + ''.join(f', {variant.rsplit(".", 1)[1]} {len(variant_body)}'
+                        for variant, variant_body in variants.items() if variant != built))
+
+    write_file(os.path.join(dist_dir, MANIFEST_NAME), json.dumps(manifest, indent=2).encode('utf-8'))
+    for directory, _, filenames in os.walk(dist_dir):
+        for filename in filenames:
+            relative = os.path.relpath(os.path.join(directory, filename), dist_dir).replace(os.sep, '/')
+            if relative not in written:
+                os.remove(os.path.join(directory, filename))
+    return manifest
+
+
+if __name__ == '__main__':
+    build(sys.argv[1] if len(sys.argv) > 1 else STATIC_DIR)
@@ -0,0 +1,117 @@
+import zlib
+
+import brotli
+from flask import request
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/javascript', 'text/')
+
+
+class GzipEncoder:
+    def __init__(self, level):
+        # wbits=31 writes the gzip header and trailer rather than a bare zlib stream
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliEncoder:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class ResponseCompressor:
+    """Compresses text responses with brotli or gzip, as the client accepts.
+
+    Bodies smaller than `min_size` are left alone since the headers would
+    outweigh the savings. Streamed responses are compressed chunk by chunk
+    and flushed after each one, so rows still reach the client as they are
+    serialized. Strong ETags are made weak on the way out because the
+    encoded bytes differ from the identity representation they describe.
+    """
+
+    def __init__(self, min_size=500, gzip_level=6, brotli_quality=4):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def init_app(self, app):
+        self.min_size = app.config.get('COMPRESS_MIN_SIZE', self.min_size)
+        self.gzip_level = app.config.get('COMPRESS_GZIP_LEVEL', self.gzip_level)
+        self.brotli_quality = app.config.get('COMPRESS_BROTLI_QUALITY', self.brotli_quality)
+        app.after_request(self.compress_response)
+
+    def choose_encoding(self):
+        accepted = request.accept_encodings
+        if accepted['br'] and accepted['br'] >= accepted['gzip']:
+            return 'br'
+        if accepted['gzip']:
+            return 'gzip'
+        return None
+
+    def encoder(self, encoding):
+        if encoding == 'br':
+            return BrotliEncoder(self.brotli_quality)
+        return GzipEncoder(self.gzip_level)
+
+    def compress_response(self, response):
+        if response.status_code != 200 or response.direct_passthrough \
+                or 'Content-Encoding' in response.headers \
+                or not (response.mimetype or '').startswith(COMPRESSIBLE_MIMETYPES):
+            return response
+        if not response.is_streamed and response.content_length is not None \
+                and response.content_length < self.min_size:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = self.choose_encoding()
+        if encoding is None:
+            return response
+
+        encoder = self.encoder(encoding)
+        if response.is_streamed:
+            response.response = self.stream(encoder, response.response)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            response.set_data(encoder.compress(body) + encoder.finish())
+
+        response.content_encoding = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    @staticmethod
+    def stream(encoder, chunks):
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                compressed = encoder.compress(chunk) + encoder.flush()
+                if compressed:
+                    yield compressed
+            yield encoder.finish()
+        finally:
+            # Closing the original iterable ends stream_with_context's request context
+            close = getattr(chunks, 'close', None)
+            if close:
+                close()
+
+
+compressor = ResponseCompressor()
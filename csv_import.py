@@ -0,0 +1,344 @@
+import csv
+import hashlib
+import io
+import re
+from datetime import datetime
+
+from sqlalchemy import insert, select, update
+
+from bookings import booking_bounds
+from database import db
+from models import Activity, Location
+from usage import usage_rollups
+
+# Any of these in a line marks the header row of a venue export; the lines
+# before it are report metadata.
+HEADER_COLUMNS = ("Date de l'évènement", "Nom de la salle", "Heure de début", "Location name", "Start time")
+TITLE_COLUMNS = ("Nom de l'événement ou de type", "nom de l'événement", "nom de l’événement")
+# Headers of exports made with the booking system in English, by the French
+# column they hold (matched case-insensitively)
+COLUMN_ALIASES = {
+    'location name': "Nom de la salle",
+    'start time': "Heure de début",
+    'end time': "Heure de fin",
+    'event title': "nom de l’événement",
+}
+# Without these a row would be imported with no room or times
+REQUIRED_COLUMNS = ("Date de l'évènement", "Nom de la salle", "Heure de début", "Heure de fin")
+TIME_PATTERN = re.compile(r'^(\d{1,2})[H:](\d{2})$')
+MAX_REPORTED_ERRORS = 500
+IMPORT_MODES = ('upsert', 'append')
+# Fields compared through `content_hash` to tell a changed booking from an unchanged one
+HASHED_FIELDS = ('title', 'time', 'end_time', 'location_name', 'notes', 'client_count')
+# Contract numbers of the booking system ("PX24071615"), which imports store in `notes`
+CONTRACT_PATTERN = re.compile(r'^[A-Z]{1,4}\d{6,}$')
+# An upsert removing more than this share of the bookings its export covers
+# is refused unless confirmed, as it more likely means a misread export
+MAX_REMOVED_SHARE = 0.2
+
+
+class ImportFormatError(Exception):
+    pass
+
+
+class ImportRowError(Exception):
+    pass
+
+
+def detect_encoding(binary_stream, sample_size=64 * 1024):
+    """UTF-8 when the start of the upload decodes as such, else Windows-1252,
+    which is what the booking system exports when not asked for UTF-8."""
+    sample = binary_stream.read(sample_size)
+    binary_stream.seek(0)
+    try:
+        sample.decode('utf-8-sig')
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut by the sample boundary is still UTF-8
+        if e.start < len(sample) - 3:
+            return 'cp1252'
+    return 'utf-8-sig'
+
+
+def export_columns(header):
+    """Field names for a header row, with English headers renamed to the
+    French columns they stand for."""
+    columns = []
+    for name in header:
+        column = COLUMN_ALIASES.get(name.strip().lower(), name)
+        # A file carrying both names keeps the French column's values
+        columns.append(name if column != name and column in header else column)
+    missing = [column for column in REQUIRED_COLUMNS if column not in columns]
+    if missing:
+        raise ImportFormatError(f"Invalid CSV format: missing columns {', '.join(missing)}")
+    return columns
+
+
+def read_export_rows(binary_stream):
+    """Yield (line_number, row) for each data row of a venue export, decoding
+    the upload as it is read instead of loading it into memory. Rows are keyed
+    by the French column names whichever language the export was made in."""
+    encoding = detect_encoding(binary_stream)
+    text_stream = io.TextIOWrapper(binary_stream, encoding=encoding, newline='')
+    try:
+        line_number = 0
+        for line in text_stream:
+            line_number += 1
+            if any(column in line for column in HEADER_COLUMNS):
+                break
+        else:
+            raise ImportFormatError('Invalid CSV format: header row not found')
+
+        columns = export_columns(next(csv.reader([line], delimiter=';')))
+        reader = csv.DictReader(text_stream, fieldnames=columns, delimiter=';')
+        for row in reader:
+            if any((value or '').strip() for value in row.values()):
+                yield line_number + reader.line_num, row
+    finally:
+        # Leave the upload open for the caller
+        text_stream.detach()
+
+
+def normalize_time(value):
+    """'7H00' / '07H00' / '07:00' -> '07:00'; empty -> None. '24H00' is kept
+    as the exports use it for bookings running until midnight."""
+    value = (value or '').strip().upper()
+    if not value:
+        return None
+    match = TIME_PATTERN.match(value)
+    if not match:
+        raise ImportRowError(f'Invalid time: {value}')
+    hours, minutes = int(match.group(1)), int(match.group(2))
+    if minutes > 59 or hours > 24 or (hours == 24 and minutes):
+        raise ImportRowError(f'Invalid time: {value}')
+    return f'{hours:02d}:{minutes:02d}'
+
+
+def parse_client_count(value):
+    value = (value or '').strip()
+    if not value:
+        return None
+    try:
+        count = int(value)
+    except ValueError:
+        raise ImportRowError(f'Invalid client count: {value}')
+    if count < 0:
+        raise ImportRowError(f'Invalid client count: {value}')
+    return count
+
+
+def external_key(contract, date, location_name, start_time, title):
+    """Identity of a booking across exports.
+
+    A contract covers every room and day of a booking, so the key adds those
+    and the start time; rows without a contract fall back to their title.
+    A booking rescheduled or moved to another room gets a new key, so an
+    upsert import removes the old row (see covered_bookings).
+    """
+    parts = [contract or f'~{title}', date.strftime('%Y-%m-%d'), location_name, start_time or '']
+    return '|'.join(parts)[:255]
+
+
+def key_group(key):
+    """The contract (or ~title) part of an external key."""
+    return key.split('|', 1)[0]
+
+
+def content_hash(values):
+    digest = hashlib.sha1()
+    for field in HASHED_FIELDS:
+        value = values.get(field)
+        digest.update(('' if value is None else str(value)).encode('utf-8') + b'\x1f')
+    return digest.hexdigest()
+
+
+def parse_row(row):
+    """Activity column values for one export row, with the room name still unresolved."""
+    date_str = (row.get("Date de l'évènement") or '').strip()
+    try:
+        date = datetime.strptime(date_str, '%d-%m-%Y')
+    except ValueError:
+        raise ImportRowError(f'Invalid date: {date_str}')
+
+    title = next((row[column].strip() for column in TITLE_COLUMNS if (row.get(column) or '').strip()),
+                 'Événement importé')[:128]
+    start_time = normalize_time(row.get('Heure de début'))
+    location_name = (row.get('Nom de la salle') or '').strip()
+    contract = (row.get('Contrat #') or '').strip()
+    values = {
+        'title': title,
+        'date': date,
+        'time': start_time,
+        'end_time': normalize_time(row.get('Heure de fin')),
+        'location_name': location_name,
+        'notes': contract,  # Using contract number as notes
+        'client_count': parse_client_count(row.get('Comte Clients')),
+        'is_all_day': not start_time,
+        'is_recurring': False,
+        'external_key': external_key(contract, date, location_name, start_time, title)
+    }
+    values['start_at'], values['end_at'] = booking_bounds(date, start_time, None, values['end_time'], not start_time)
+    values['content_hash'] = content_hash(values)
+    return values
+
+
+def resolve_locations(location_ids, names):
+    """Fill `location_ids` (name -> id) for `names`, creating missing rooms in one INSERT."""
+    missing = sorted(name for name in names if name not in location_ids)
+    if missing:
+        db.session.execute(insert(Location), [{'name': name} for name in missing])
+        location_ids.update(db.session.execute(
+            select(Location.name, Location.id).where(Location.name.in_(missing))
+        ).all())
+
+
+def split_existing(rows):
+    """Split a chunk into (new rows, updates for changed bookings, unchanged count)
+    with one lookup of the chunk's external keys."""
+    existing = {}
+    for key, activity_id, stored_hash in db.session.execute(
+        select(Activity.external_key, Activity.id, Activity.content_hash)
+        .where(Activity.external_key.in_([row['external_key'] for row in rows]))
+    ):
+        existing.setdefault(key, []).append((activity_id, stored_hash))
+
+    new_rows, updates, unchanged = [], [], 0
+    now = datetime.utcnow()
+    for row in rows:
+        matches = existing.get(row['external_key'])
+        if not matches:
+            new_rows.append(row)
+            continue
+        changed = [activity_id for activity_id, stored_hash in matches if stored_hash != row['content_hash']]
+        if not changed:
+            unchanged += 1
+        for activity_id in changed:
+            updates.append({**row, 'id': activity_id, 'updated_at': now})
+    return new_rows, updates, unchanged
+
+
+def covered_bookings(groups, first, last):
+    """Imported rows of the export's contracts dated within the days it
+    covers; those it no longer lists were since rescheduled, moved to another
+    room or cancelled."""
+    rows = db.session.execute(
+        select(Activity.id, Activity.external_key, Activity.start_at, Activity.end_at)
+        .where(Activity.external_key.is_not(None), Activity.date.between(first, last))
+    ).all()
+    return [row for row in rows if key_group(row.external_key) in groups]
+
+
+def found_activities(report):
+    """Whether an import report saw at least one valid booking."""
+    return bool(report['count'] or report['updated'] or report['unchanged'])
+
+
+def wrote_activities(report):
+    """Whether an import inserted, updated or removed anything."""
+    return bool(report['count'] or report['updated'] or report['removed'])
+
+
+def import_activities_csv(binary_stream, chunk_size=1000, progress=None, mode='upsert', conflict_checker=None,
+                          delete_activities=None, confirm_removal=False):
+    """Parse a venue export and write its activities in bulk, chunk by chunk.
+
+    In 'upsert' mode bookings already imported (same external key) are
+    updated when their content changed and left alone otherwise, and once
+    the whole export is read, rows it no longer lists are removed with
+    `delete_activities(condition)` (see covered_bookings). Removal is skipped
+    when some rows had no room or start time, and refused with
+    ImportFormatError above MAX_REMOVED_SHARE, unless `confirm_removal`.
+    'append' inserts every row. Runs inside the caller's transaction and
+    returns a report: rows parsed, inserted (`count`), updated, unchanged,
+    removed, skipped (no date) and failed (invalid, or the same key as an
+    earlier row), plus per-row errors and room conflicts. `conflict_checker(rows, exclude_ids)` is given each chunk's
+    written rows at once; conflicting bookings are still imported, since the
+    export is the booking system's record, but are reported. `progress` is called with the
+    report after every chunk and may raise to abort the import.
+    """
+    if mode not in IMPORT_MODES:
+        raise ImportFormatError(f'Invalid import mode: {mode}')
+    report = {'parsed': 0, 'count': 0, 'updated': 0, 'unchanged': 0, 'removed': 0,
+              'skipped': 0, 'failed': 0, 'errors': [], 'conflicts': 0, 'conflict_details': []}
+    location_ids = dict(db.session.execute(select(Location.name, Location.id)).all())
+    seen_keys = {}
+    dates = []
+    # Rows lacking a room or start time share keys too easily to tell which bookings are gone
+    partial = False
+    conflicts_found = []
+    pending = []
+
+    def flush():
+        resolve_locations(location_ids, {row['location_name'] for row in pending if row['location_name']})
+        for row in pending:
+            row['location_id'] = location_ids.get(row.pop('location_name'))
+        new_rows, updates = pending, []
+        if mode == 'upsert':
+            new_rows, updates, unchanged = split_existing(pending)
+            report['unchanged'] += unchanged
+        if conflict_checker:
+            conflicts = conflict_checker(new_rows + updates, [row['id'] for row in updates])
+            conflicts_found.extend(conflicts)
+            report['conflicts'] += len(conflicts)
+            room = MAX_REPORTED_ERRORS - len(report['conflict_details'])
+            report['conflict_details'].extend(conflicts[:max(room, 0)])
+        for row in new_rows + updates:
+            row.pop('line')
+        usage_rollups.invalidate_spans((row['start_at'], row['end_at']) for row in new_rows + updates)
+        if new_rows:
+            db.session.execute(insert(Activity), new_rows)
+        if updates:
+            db.session.execute(update(Activity), updates)
+        report['count'] += len(new_rows)
+        report['updated'] += len(updates)
+        pending.clear()
+        if progress:
+            progress(report)
+
+    for line_number, row in read_export_rows(binary_stream):
+        report['parsed'] += 1
+        if not (row.get("Date de l'évènement") or '').strip():
+            # Subtotal and footer lines of the export carry no date
+            report['skipped'] += 1
+            continue
+        try:
+            values = parse_row(row)
+            if mode == 'upsert' and values['external_key'] in seen_keys:
+                raise ImportRowError(f"Same contract, day, room and start time as line {seen_keys[values['external_key']]}")
+        except ImportRowError as e:
+            report['failed'] += 1
+            if len(report['errors']) < MAX_REPORTED_ERRORS:
+                report['errors'].append({'line': line_number, 'error': str(e)})
+            continue
+        if mode == 'upsert':
+            seen_keys[values['external_key']] = line_number
+            dates.append(values['date'])
+            partial = partial or not (values['location_name'] and values['time'])
+        values['line'] = line_number
+        pending.append(values)
+        if len(pending) >= chunk_size:
+            flush()
+
+    if pending:
+        flush()
+
+    if mode == 'upsert' and delete_activities and seen_keys and (confirm_removal or not partial):
+        covered = covered_bookings({key_group(key) for key in seen_keys}, min(dates), max(dates))
+        missing = [row for row in covered if row.external_key not in seen_keys]
+        if missing and not confirm_removal and len(missing) > MAX_REMOVED_SHARE * len(covered):
+            raise ImportFormatError(f'Import would remove {len(missing)} of the {len(covered)} bookings '
+                                    f'the export covers; confirm the removal to proceed')
+        if missing:
+            usage_rollups.invalidate_spans((row.start_at, row.end_at) for row in missing)
+            report['removed'] = delete_activities(Activity.id.in_([row.id for row in missing]))
+            # A rescheduled booking was checked against its own old row
+            removed_ids = {row.id for row in missing}
+            remaining = []
+            for conflict in conflicts_found:
+                others = [other for other in conflict['conflicts_with'] if other['id'] not in removed_ids]
+                if others:
+                    remaining.append(dict(conflict, conflicts_with=others))
+            report['conflicts'] = len(remaining)
+            report['conflict_details'] = remaining[:MAX_REPORTED_ERRORS]
+            if progress:
+                progress(report)
+    return report
@@ -0,0 +1,134 @@
+import logging
+import smtplib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask_mail import Message
+from sqlalchemy import select, update
+
+import background
+from database import db
+from models import User
+
+logger = logging.getLogger(__name__)
+
+DIGEST_FREQUENCIES = ('daily', 'weekly')
+# Days of upcoming activities each digest lists, today included
+UPCOMING_DAYS = {'daily': 2, 'weekly': 7}
+# Changes reported by a subscriber's first digest
+FIRST_DIGEST_LOOKBACK = {'daily': timedelta(days=1), 'weekly': timedelta(days=7)}
+# A rerun of the job sooner than this after a digest sends nothing more
+MIN_INTERVAL = {'daily': timedelta(hours=20), 'weekly': timedelta(days=6)}
+
+
+class DigestSender:
+    """Daily and weekly summaries of upcoming and changed activities.
+
+    Runs as a cron job on the background scheduler. One query gathers the
+    activities every due subscriber needs. Subscribers with the same
+    frequency and last digest share one rendered body. The messages are
+    then sent over a few SMTP connections in parallel.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.mail = None
+        self.collect = None
+        self.render = None
+
+    def init_app(self, app, mail, collect, render):
+        """`collect(start, end, changed_since)` returns (occurrence dicts
+        overlapping the days [start, end], activity dicts changed since
+        `changed_since`, each with its 'updated_at' and a 'created' flag);
+        `render(frequency, upcoming, changed)` returns (subject, body)."""
+        self.app = app
+        self.mail = mail
+        self.collect = collect
+        self.render = render
+
+    def start(self):
+        background.ensure_started()
+        background.scheduler.add_job(self.run, 'cron', id='digests', replace_existing=True,
+                                     hour=self.app.config['DIGEST_HOUR'], minute=0)
+
+    def is_due(self, user, now, stamp):
+        if user.digest_frequency == 'weekly' and now.weekday() != self.app.config['DIGEST_WEEKDAY']:
+            return False
+        return user.last_digest_at is None or stamp - user.last_digest_at >= MIN_INTERVAL[user.digest_frequency]
+
+    def changed_since(self, user, stamp):
+        return user.last_digest_at or stamp - FIRST_DIGEST_LOOKBACK[user.digest_frequency]
+
+    def run(self, now=None):
+        """Send the digests due at local time `now`; returns how many were sent."""
+        with self.app.app_context():
+            now = now or datetime.now()
+            # Change times and last_digest_at are UTC, like the other timestamps
+            stamp = datetime.utcnow()
+            users = [user for user in db.session.execute(
+                select(User).where(User.digest_frequency.in_(DIGEST_FREQUENCIES))
+            ).scalars() if self.is_due(user, now, stamp)]
+            if not users:
+                return 0
+
+            today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+            horizon = today + timedelta(days=max(UPCOMING_DAYS[user.digest_frequency] for user in users) - 1)
+            upcoming, changed = self.collect(today, horizon, min(self.changed_since(user, stamp) for user in users))
+
+            rendered = {}
+            messages, empty_ids = [], []
+            for user in users:
+                since = self.changed_since(user, stamp)
+                key = (user.digest_frequency, since)
+                if key not in rendered:
+                    last_day = today + timedelta(days=UPCOMING_DAYS[user.digest_frequency] - 1)
+                    user_upcoming = [item for item in upcoming
+                                     if item['date'] <= last_day.strftime('%Y-%m-%d')]
+                    user_changed = [item for item in changed if item['updated_at'] >= since]
+                    rendered[key] = self.render(user.digest_frequency, user_upcoming, user_changed) \
+                        if user_upcoming or user_changed else None
+                if rendered[key]:
+                    messages.append((user.id, user.email, rendered[key]))
+                else:
+                    empty_ids.append(user.id)
+
+            sent_ids = self.send(messages)
+            # Users whose digest failed keep their stamp and are retried on the next run
+            done_ids = empty_ids + sent_ids
+            if done_ids:
+                db.session.execute(update(User).where(User.id.in_(done_ids)).values(last_digest_at=stamp))
+                db.session.commit()
+            logger.info('Sent %d digests (%d failed, %d empty)', len(sent_ids), len(messages) - len(sent_ids),
+                        len(empty_ids))
+            return len(sent_ids)
+
+    def send(self, messages):
+        """Send (user id, address, (subject, body)) messages, splitting them
+        across DIGEST_SMTP_CONNECTIONS connections; returns the ids sent."""
+        if not messages:
+            return []
+        connections = min(self.app.config['DIGEST_SMTP_CONNECTIONS'], len(messages))
+        batches = [messages[position::connections] for position in range(connections)]
+        with ThreadPoolExecutor(connections) as pool:
+            return [user_id for sent in pool.map(self.send_batch, batches) for user_id in sent]
+
+    def send_batch(self, messages):
+        sent = []
+        with self.app.app_context():
+            sender = self.app.config['MAIL_DEFAULT_SENDER'] or self.app.config['MAIL_USERNAME']
+            try:
+                with self.mail.connect() as connection:
+                    for user_id, address, (subject, body) in messages:
+                        try:
+                            connection.send(Message(subject=subject, recipients=[address], body=body, sender=sender))
+                            sent.append(user_id)
+                        except smtplib.SMTPServerDisconnected:
+                            raise
+                        except Exception as e:
+                            logger.warning('Digest for user %s failed: %s', user_id, e)
+            except Exception as e:
+                logger.error('Digest batch stopped after %d of %d messages: %s', len(sent), len(messages), e)
+        return sent
+
+
+digests = DigestSender()
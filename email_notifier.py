@@ -1,62 +1,112 @@
-from flask_mail import Mail, Message
-from flask import current_app
-from datetime import datetime, timedelta
+from flask_mail import Mail
+from email_queue import email_queue
 
 mail = Mail()
 
+# What a series edit or delete applied to, by scope (see parse_series_scope)
+SCOPE_LABELS = {
+    'occurrence': 'This occurrence only',
+    'following': 'This and following occurrences',
+    'series': 'All occurrences'
+}
+
 class EmailNotifier:
+    # Notifications are queued and sent in the background (see email_queue);
+    # messages are rendered from a snapshot of the activity taken when queued.
+
     @staticmethod
-    def send_activity_notification(recipients, subject, content):
-        with current_app.app_context():
-            msg = Message(
-                subject=subject,
-                recipients=recipients,
-                body=content,
-                sender=current_app.config['MAIL_USERNAME']
-            )
-            mail.send(msg)
+    def activity_payload(activity):
+        return {
+            'title': activity.title,
+            'date': activity.date.strftime('%Y-%m-%d'),
+            'time': activity.time,
+            'location': activity.location_obj.name if activity.location_obj else None,
+            'categories': [c.name for c in activity.categories]
+        }
 
     @staticmethod
-    def notify_activity_created(activity, recipients):
-        subject = "New Activity Added: " + activity.title
+    def render(kind, payload):
+        occurrences = f"\nOccurrences: {SCOPE_LABELS[payload['scope']]}" if payload.get('scope') else ''
+        if kind == 'deleted':
+            subject = "Activity Deleted: " + payload['title']
+            content = f"""
+An activity has been removed from the calendar:
+
+Title: {payload['title']}
+Date: {payload['date']}{occurrences}
+
+Please check the calendar for the updated schedule.
+"""
+            return subject, content
+
+        if kind == 'created':
+            subject = "New Activity Added: " + payload['title']
+            intro = "A new activity has been added to the calendar:"
+        else:
+            subject = "Activity Updated: " + payload['title']
+            intro = "An activity has been updated in the calendar:"
         content = f"""
-A new activity has been added to the calendar:
+{intro}
 
-Title: {activity.title}
-Date: {activity.date.strftime('%Y-%m-%d')}
-Time: {activity.time or 'Not specified'}
-Location: {activity.location_obj.name if activity.location_obj else 'Not specified'}
-Categories: {', '.join(c.name for c in activity.categories)}
+Title: {payload['title']}
+Date: {payload['date']}{occurrences}
+Time: {payload['time'] or 'Not specified'}
+Location: {payload['location'] or 'Not specified'}
+Categories: {', '.join(payload['categories'])}
 
 Visit the calendar to view more details.
 """
-        EmailNotifier.send_activity_notification(recipients, subject, content)
+        return subject, content
 
     @staticmethod
-    def notify_activity_updated(activity, recipients):
-        subject = "Activity Updated: " + activity.title
-        content = f"""
-An activity has been updated in the calendar:
+    def render_digest(frequency, upcoming, changed):
+        def line(item):
+            when = item['date'] + (f" {item['time']}" if item.get('time') else '')
+            where = f" ({item['location']})" if item.get('location') else ''
+            return f"{when} - {item['title']}{where}"
 
-Title: {activity.title}
-Date: {activity.date.strftime('%Y-%m-%d')}
-Time: {activity.time or 'Not specified'}
-Location: {activity.location_obj.name if activity.location_obj else 'Not specified'}
-Categories: {', '.join(c.name for c in activity.categories)}
+        sections = []
+        if upcoming:
+            sections.append("Upcoming activities:\n" + "\n".join('  ' + line(item) for item in upcoming))
+        if changed:
+            sections.append("Changes since your last digest:\n" + "\n".join(
+                ('  [New] ' if item['created'] else '  [Updated] ') + line(item) for item in changed
+            ))
+        subject = f"Your {frequency} calendar digest"
+        content = "\n" + "\n\n".join(sections) + """
 
 Visit the calendar to view more details.
 """
-        EmailNotifier.send_activity_notification(recipients, subject, content)
+        return subject, content
 
     @staticmethod
-    def notify_activity_deleted(activity_title, activity_date, recipients):
-        subject = "Activity Deleted: " + activity_title
-        content = f"""
-An activity has been removed from the calendar:
+    def notify_activity_created(activity, recipients):
+        email_queue.enqueue(('activity', activity.id), 'created', recipients,
+                            EmailNotifier.activity_payload(activity))
 
-Title: {activity_title}
-Date: {activity_date}
+    @staticmethod
+    def notify_activity_updated(activity, recipients):
+        email_queue.enqueue(('activity', activity.id), 'updated', recipients,
+                            EmailNotifier.activity_payload(activity))
 
-Please check the calendar for the updated schedule.
-"""
-        EmailNotifier.send_activity_notification(recipients, subject, content)
\ No newline at end of file
+    @staticmethod
+    def notify_activity_deleted(activity_id, activity_title, activity_date, recipients):
+        email_queue.enqueue(('activity', activity_id), 'deleted', recipients,
+                            {'title': activity_title, 'date': activity_date})
+
+    # Scoped edits and deletes of a series are keyed by the series, so several
+    # occurrences changed in a row make one message rather than one each.
+
+    @staticmethod
+    def notify_series_updated(series_id, activity, scope, date, recipients, exception=None):
+        payload = dict(EmailNotifier.activity_payload(activity), date=date.strftime('%Y-%m-%d'), scope=scope)
+        if exception is not None:
+            # An occurrence edited in place keeps the series' categories
+            payload.update(title=exception.title, time=exception.time,
+                           location=exception.location_obj.name if exception.location_obj else None)
+        email_queue.enqueue(('series', series_id), 'updated', recipients, payload)
+
+    @staticmethod
+    def notify_series_deleted(series_id, activity_title, scope, date, recipients):
+        email_queue.enqueue(('series', series_id), 'deleted', recipients,
+                            {'title': activity_title, 'date': date.strftime('%Y-%m-%d'), 'scope': scope})
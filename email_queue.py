@@ -0,0 +1,143 @@
+import logging
+import smtplib
+import threading
+from datetime import datetime, timedelta
+
+from flask_mail import Message
+
+import background
+
+logger = logging.getLogger(__name__)
+
+
+def coalesce(previous, kind):
+    """Kind of the single message left when `kind` follows a pending
+    `previous` change to the same record; None when nothing is left to say."""
+    if previous == 'created':
+        return None if kind == 'deleted' else 'created'
+    return kind
+
+
+class PendingEmail:
+    def __init__(self, key, kind, recipients, payload, due_at):
+        self.key = key
+        self.kind = kind
+        self.recipients = set(recipients)
+        self.payload = payload
+        self.due_at = due_at
+        self.attempts = 0
+
+
+class EmailQueue:
+    """Outbound notifications sent by the background scheduler instead of
+    inside requests.
+
+    Changes to the same record (same `key`) within the coalescing window
+    become one message rendered from the latest payload. Due messages go out
+    in batches over a single SMTP connection; failed ones are retried with
+    exponential backoff and dropped after the last attempt. The queue lives
+    in this process, like import jobs.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.mail = None
+        self.render = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._scheduled = False
+
+    def init_app(self, app, mail, render):
+        """`render(kind, payload)` returns the (subject, body) of a message."""
+        self.app = app
+        self.mail = mail
+        self.render = render
+
+    def enqueue(self, key, kind, recipients, payload):
+        if not self.app.config['EMAIL_NOTIFICATIONS'] or not recipients:
+            return
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                due_at = datetime.utcnow() + timedelta(seconds=self.app.config['EMAIL_COALESCE_SECONDS'])
+                self._pending[key] = PendingEmail(key, kind, recipients, payload, due_at)
+            else:
+                # The first change's due time stands, so coalescing never delays a message further
+                pending.kind = coalesce(pending.kind, kind)
+                pending.recipients.update(recipients)
+                pending.payload = payload
+                if pending.kind is None:
+                    del self._pending[key]
+            self._ensure_scheduled()
+
+    def _ensure_scheduled(self):
+        if not self._scheduled:
+            background.ensure_started()
+            background.scheduler.add_job(self.flush, 'interval', id='email-flush', replace_existing=True,
+                                         seconds=self.app.config['EMAIL_FLUSH_INTERVAL'])
+            self._scheduled = True
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Send the due messages, up to one batch, over one connection."""
+        now = datetime.utcnow()
+        with self._lock:
+            due = sorted((pending for pending in self._pending.values() if pending.due_at <= now),
+                         key=lambda pending: pending.due_at)[:self.app.config['EMAIL_BATCH_SIZE']]
+            for pending in due:
+                del self._pending[pending.key]
+        if not due:
+            return
+
+        sent, failed = set(), []
+        with self.app.app_context():
+            sender = self.app.config['MAIL_DEFAULT_SENDER'] or self.app.config['MAIL_USERNAME']
+            try:
+                with self.mail.connect() as connection:
+                    for pending in due:
+                        subject, body = self.render(pending.kind, pending.payload)
+                        try:
+                            connection.send(Message(subject=subject, recipients=sorted(pending.recipients),
+                                                    body=body, sender=sender))
+                            sent.add(pending.key)
+                        except smtplib.SMTPServerDisconnected:
+                            raise
+                        except smtplib.SMTPRecipientsRefused as e:
+                            # Permanent: another attempt would be refused again
+                            logger.error('Dropping email %s, recipients refused: %s', pending.key, e)
+                        except Exception as e:
+                            failed.append((pending, e))
+            except Exception as e:
+                # Could not connect, or lost the connection: the rest of the batch waits too
+                failed_keys = {pending.key for pending, _ in failed}
+                failed.extend((pending, e) for pending in due
+                              if pending.key not in sent and pending.key not in failed_keys)
+
+        for pending, error in failed:
+            self._retry(pending, error)
+
+    def _retry(self, pending, error):
+        pending.attempts += 1
+        if pending.attempts >= self.app.config['EMAIL_MAX_ATTEMPTS']:
+            logger.error('Dropping email %s after %d attempts: %s', pending.key, pending.attempts, error)
+            return
+        delay = self.app.config['EMAIL_RETRY_SECONDS'] * 2 ** (pending.attempts - 1)
+        pending.due_at = datetime.utcnow() + timedelta(seconds=delay)
+        logger.warning('Email %s failed (attempt %d), retrying in %ds: %s', pending.key, pending.attempts, delay, error)
+        with self._lock:
+            newer = self._pending.get(pending.key)
+            if newer is None:
+                self._pending[pending.key] = pending
+            else:
+                # Changed again meanwhile: send one message with the newer content
+                newer.kind = coalesce(pending.kind, newer.kind)
+                newer.recipients |= pending.recipients
+                newer.due_at = min(newer.due_at, pending.due_at)
+                if newer.kind is None:
+                    del self._pending[pending.key]
+
+
+email_queue = EmailQueue()
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+# iCalendar (RFC 5545) rendering of the activity dicts served by /api/activities.
+# Times are written as floating local times: the calendar has a single venue
+# and X-WR-TIMEZONE tells clients which zone that is.
+
+LINE_LIMIT = 75
+
+
+def escape_text(value):
+    return (value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def fold_line(line):
+    """Split a content line into 75-octet pieces joined by CRLF + space."""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= LINE_LIMIT:
+        return line + '\r\n'
+    pieces = []
+    start = 0
+    limit = LINE_LIMIT
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # Never cut a multi-byte character in half
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1
+        pieces.append(encoded[start:end].decode('utf-8'))
+        start = end
+        limit = LINE_LIMIT - 1  # continuation lines start with a space
+    return '\r\n '.join(pieces) + '\r\n'
+
+
+def parse_local(date_str, time_str):
+    day = datetime.strptime(date_str, '%Y-%m-%d')
+    hours, minutes = (int(part) for part in time_str.split(':')[:2])
+    # '24:00' closes a booking at midnight
+    return day + timedelta(hours=hours, minutes=minutes)
+
+
+def event_lines(item, stamp, uid_domain):
+    """Content lines of one VEVENT for an activity or series occurrence dict."""
+    if item.get('occurrence_date'):
+        uid = f"{item['series_id']}-{item['occurrence_date']}@{uid_domain}"
+    else:
+        uid = f"{item['id']}@{uid_domain}"
+    lines = ['BEGIN:VEVENT', f'UID:{uid}', f'DTSTAMP:{stamp}']
+
+    last_day = item.get('end_date') or item['date']
+    if item.get('is_all_day') or not item.get('time'):
+        end = datetime.strptime(last_day, '%Y-%m-%d') + timedelta(days=1)
+        lines.append(f"DTSTART;VALUE=DATE:{item['date'].replace('-', '')}")
+        lines.append(f"DTEND;VALUE=DATE:{end.strftime('%Y%m%d')}")
+    else:
+        start = parse_local(item['date'], item['time'])
+        lines.append(f"DTSTART:{start.strftime('%Y%m%dT%H%M%S')}")
+        if item.get('end_time'):
+            end = parse_local(last_day, item['end_time'])
+            if end > start:
+                lines.append(f"DTEND:{end.strftime('%Y%m%dT%H%M%S')}")
+
+    lines.append(f"SUMMARY:{escape_text(item['title'])}")
+    if item.get('location'):
+        lines.append(f"LOCATION:{escape_text(item['location'])}")
+    if item.get('notes'):
+        lines.append(f"DESCRIPTION:{escape_text(item['notes'])}")
+    if item.get('categories'):
+        lines.append('CATEGORIES:' + ','.join(escape_text(category['name']) for category in item['categories']))
+    lines.append('END:VEVENT')
+    return lines
+
+
+def generate_calendar(items, name, timezone, stamp, uid_domain):
+    """Yield the feed as text chunks, one event at a time.
+
+    `stamp` is the DTSTAMP shared by every event, normally the last time the
+    calendar data changed.
+    """
+    stamp = stamp.strftime('%Y%m%dT%H%M%SZ')
+    header = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//CFSJ//Calendrier//FR',
+              'CALSCALE:GREGORIAN', 'METHOD:PUBLISH',
+              f'X-WR-CALNAME:{escape_text(name)}', f'X-WR-TIMEZONE:{timezone}']
+    yield ''.join(fold_line(line) for line in header)
+    for item in items:
+        yield ''.join(fold_line(line) for line in event_lines(item, stamp, uid_domain))
+    yield fold_line('END:VCALENDAR')
@@ -0,0 +1,151 @@
+import os
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import background
+from csv_import import import_activities_csv, found_activities, wrote_activities, ImportFormatError
+from database import db
+
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+# Finished jobs stay queryable this long so the admin page can fetch the report
+JOB_RETENTION = timedelta(hours=1)
+
+
+class ImportCancelled(Exception):
+    pass
+
+
+class ImportJob:
+    def __init__(self, path, user_id, mode, confirm_removal=False):
+        self.id = uuid.uuid4().hex
+        self.path = path
+        self.user_id = user_id
+        self.mode = mode
+        self.confirm_removal = confirm_removal
+        self.status = 'queued'
+        self.report = {'parsed': 0, 'count': 0, 'updated': 0, 'unchanged': 0, 'removed': 0,
+                       'skipped': 0, 'failed': 0, 'errors': [], 'conflicts': 0, 'conflict_details': []}
+        self.error = None
+        self.cancel_requested = False
+        self.created_at = datetime.utcnow()
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'mode': self.mode,
+            'parsed': self.report['parsed'],
+            'inserted': self.report['count'],
+            'updated': self.report['updated'],
+            'unchanged': self.report['unchanged'],
+            'removed': self.report['removed'],
+            'skipped': self.report['skipped'],
+            'failed': self.report['failed'],
+            'errors': self.report['errors'],
+            'conflicts': self.report['conflicts'],
+            'conflict_details': self.report['conflict_details'],
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+class ImportJobRunner:
+    """Runs CSV imports on the background scheduler's import pool.
+
+    Job state lives in this process, so the app must be served by a single
+    worker process (as `python app.py` does) for status polling to find it.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.on_commit = None
+        self.conflict_checker = None
+        self.delete_activities = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app, on_commit, conflict_checker=None, delete_activities=None):
+        """`on_commit` runs in the job's app context before committing an
+        import that changed anything; `conflict_checker` and
+        `delete_activities` are handed to the importer."""
+        self.app = app
+        self.on_commit = on_commit
+        self.conflict_checker = conflict_checker
+        self.delete_activities = delete_activities
+
+    def submit(self, file_storage, user_id, mode='upsert', confirm_removal=False):
+        background.ensure_started()
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'wb') as upload:
+            file_storage.save(upload)
+
+        job = ImportJob(path, user_id, mode, confirm_removal)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        background.scheduler.add_job(self._run, args=[job], executor='imports')
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job and job.status not in FINISHED_STATUSES:
+            job.cancel_requested = True
+        return job
+
+    def _run(self, job):
+        if job.cancel_requested:
+            self._finish(job, 'cancelled')
+            return
+
+        def progress(report):
+            job.report = report
+            if job.cancel_requested:
+                raise ImportCancelled()
+
+        job.status = 'running'
+        with self.app.app_context():
+            try:
+                with open(job.path, 'rb') as stream:
+                    job.report = import_activities_csv(
+                        stream, chunk_size=self.app.config['IMPORT_CHUNK_SIZE'],
+                        progress=progress, mode=job.mode, conflict_checker=self.conflict_checker,
+                        delete_activities=self.delete_activities, confirm_removal=job.confirm_removal
+                    )
+                if job.cancel_requested:
+                    raise ImportCancelled()
+                if not found_activities(job.report):
+                    raise ImportFormatError('No valid activities found in CSV')
+                if wrote_activities(job.report):
+                    self.on_commit()
+                db.session.commit()
+                self._finish(job, 'completed')
+            except ImportCancelled:
+                db.session.rollback()
+                self._finish(job, 'cancelled')
+            except Exception as e:
+                db.session.rollback()
+                job.error = str(e)
+                self._finish(job, 'failed')
+
+    def _finish(self, job, status):
+        job.status = status
+        job.finished_at = datetime.utcnow()
+        if os.path.exists(job.path):
+            os.remove(job.path)
+
+    def _prune(self):
+        cutoff = datetime.utcnow() - JOB_RETENTION
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+
+import_jobs = ImportJobRunner()
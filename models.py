@@ -2,6 +2,7 @@ from database import db
 from flask_login import UserMixin
 from datetime import datetime
 import secrets
+from bookings import booking_bounds
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -10,6 +11,9 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256))
     role = db.Column(db.String(20), nullable=False, default='reader')  # 'admin', 'creator', 'reader'
     share_token = db.Column(db.String(32), unique=True, index=True)
+    # Opt-in summary email: None, 'daily' or 'weekly' (see digests)
+    digest_frequency = db.Column(db.String(10), index=True)
+    last_digest_at = db.Column(db.DateTime)
 
     def generate_share_token(self):
         self.share_token = secrets.token_hex(16)
@@ -38,26 +42,112 @@ class Location(db.Model):
     activities = db.relationship('Activity', backref='location_obj', lazy=True)
 
 class Activity(db.Model):
+    __table_args__ = (
+        # Admin list keyset cursor: ORDER BY start_at, id
+        db.Index('ix_activity_start_id', 'start_at', 'id'),
+        # Room conflict checks and availability: one room's bookings by exact
+        # time range without touching the table
+        db.Index('ix_activity_location_start_end', 'location_id', 'start_at', 'end_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(128), nullable=False)
-    date = db.Column(db.DateTime, nullable=False)
+    date = db.Column(db.DateTime, nullable=False, index=True)
     time = db.Column(db.String(64))
     location_id = db.Column(db.Integer, db.ForeignKey('location.id'))
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     is_all_day = db.Column(db.Boolean, default=False)
     end_date = db.Column(db.DateTime)
     end_time = db.Column(db.String(64))
+    # Typed bounds derived from date/time/end_date/end_time on every write so
+    # the database can sort and range-filter on actual times (see booking_bounds)
+    start_at = db.Column(db.DateTime, index=True)
+    end_at = db.Column(db.DateTime, index=True)
     color = db.Column(db.String(7))  # Optional custom color override
     
     # Many-to-many relationship with categories
     categories = db.relationship('Category',
                                secondary=activity_categories,
-                               lazy='subquery',
+                               lazy='selectin',
                                backref=db.backref('activities', lazy=True))
     
     # Recurrence fields
     is_recurring = db.Column(db.Boolean, default=False)
     recurrence_type = db.Column(db.String(20))  # 'daily', 'weekly', 'monthly', 'annually'
-    recurrence_end_date = db.Column(db.DateTime)
+    recurrence_end_date = db.Column(db.DateTime)  # None on a series means open-ended
+    # A series is stored as this single row and expanded into occurrences at
+    # read time; older recurring activities were materialized one row each.
+    is_series = db.Column(db.Boolean, default=False, nullable=False)
+    # Shared by the rows of one of those materialized series (lowest row id)
+    series_id = db.Column(db.Integer, index=True)
+    exceptions = db.relationship('ActivityException', backref='activity',
+                                 cascade='all, delete-orphan', passive_deletes=True, lazy=True)
+
+    # Booking identity and content digest of rows imported from the venue
+    # export, so a re-import only writes what changed (see csv_import)
+    external_key = db.Column(db.String(255), index=True)
+    content_hash = db.Column(db.String(40))
+    # Attendance reported by the venue export ("Comte Clients")
+    client_count = db.Column(db.Integer)
+
+@db.event.listens_for(Activity, 'before_insert')
+@db.event.listens_for(Activity, 'before_update')
+def set_booking_bounds(mapper, connection, activity):
+    activity.start_at, activity.end_at = booking_bounds(
+        activity.date, activity.time, activity.end_date, activity.end_time, activity.is_all_day
+    )
+
+class ActivityException(db.Model):
+    # Cancelled or modified occurrence of a series, keyed by its original date.
+    # Override columns left as None inherit the series value.
+    __table_args__ = (db.UniqueConstraint('activity_id', 'occurrence_date'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    activity_id = db.Column(db.Integer, db.ForeignKey('activity.id', ondelete='CASCADE'), nullable=False, index=True)
+    occurrence_date = db.Column(db.DateTime, nullable=False)
+    is_cancelled = db.Column(db.Boolean, default=False, nullable=False)
+    title = db.Column(db.String(128))
+    time = db.Column(db.String(64))
+    end_time = db.Column(db.String(64))
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'))
+    notes = db.Column(db.Text)
+    location_obj = db.relationship('Location')
+
+class ActivityTombstone(db.Model):
+    # Activities are hard-deleted; a row here per deletion lets sync clients
+    # (/api/activities/changes) drop their copy. Pruned after SYNC_TOMBSTONE_DAYS.
+    __table_args__ = (db.Index('ix_activity_tombstone_deleted_id', 'deleted_at', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    activity_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class DataVersion(db.Model):
+    # Counter bumped in the same transaction as every calendar write; read APIs
+    # derive their ETag from it without touching the activity table.
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UsageMonth(db.Model):
+    # Months whose usage rollups are up to date; a write deletes the rows of
+    # the months it touches and they are recomputed from activities (see usage)
+    month = db.Column(db.DateTime, primary_key=True)
+    refreshed_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UsageRollup(db.Model):
+    # Bookings, booked minutes and clients of one room in one month: a row with
+    # category_id None holds the room's totals, the others its per-category
+    # share (an activity in two categories counts in both). location_id None
+    # stands for activities without a room.
+    __table_args__ = (db.Index('ix_usage_rollup_month_location', 'month', 'location_id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.DateTime, nullable=False)
+    location_id = db.Column(db.Integer)
+    category_id = db.Column(db.Integer, index=True)
+    bookings = db.Column(db.Integer, nullable=False, default=0)
+    booked_minutes = db.Column(db.Integer, nullable=False, default=0)
+    clients = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,58 @@
+import calendar
+from datetime import timedelta
+
+RECURRENCE_TYPES = ('daily', 'weekly', 'monthly', 'annually')
+
+
+def add_months(value, months):
+    """Shift a datetime by whole months, clamping the day to the target month's length."""
+    month_index = value.month - 1 + months
+    year = value.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(value.day, calendar.monthrange(year, month)[1])
+    return value.replace(year=year, month=month, day=day)
+
+
+def nth_occurrence(start, recurrence_type, n):
+    """Date of the n-th occurrence (0 is `start`), always computed from `start`
+    so monthly series on the 31st don't drift to the 28th after February."""
+    if recurrence_type == 'daily':
+        return start + timedelta(days=n)
+    if recurrence_type == 'weekly':
+        return start + timedelta(weeks=n)
+    if recurrence_type == 'monthly':
+        return add_months(start, n)
+    if recurrence_type == 'annually':
+        return add_months(start, 12 * n)
+    raise ValueError(f'Unknown recurrence type: {recurrence_type}')
+
+
+def first_index_after(start, recurrence_type, lower):
+    """Smallest n whose occurrence may be on or after `lower`, without walking
+    the series from its first date."""
+    if lower <= start:
+        return 0
+    if recurrence_type == 'daily':
+        return (lower - start).days
+    if recurrence_type == 'weekly':
+        return (lower - start).days // 7
+    months = (lower.year - start.year) * 12 + lower.month - start.month
+    if recurrence_type == 'monthly':
+        return max(months - 1, 0)
+    return max(months // 12 - 1, 0)
+
+
+def occurrence_dates(start, recurrence_type, lower, upper, until=None, duration=timedelta(0)):
+    """Yield the start of every occurrence overlapping [lower, upper).
+
+    An occurrence starting at d spans [d, d + duration]; `until` is the last
+    date an occurrence may start on, None for open-ended series.
+    """
+    n = first_index_after(start, recurrence_type, lower - duration)
+    while True:
+        current = nth_occurrence(start, recurrence_type, n)
+        if current >= upper or (until is not None and current.date() > until.date()):
+            return
+        if current + duration >= lower:
+            yield current
+        n += 1
@@ -0,0 +1,134 @@
+import re
+
+from sqlalchemy import column, func, literal_column, select, table, text
+
+from database import db
+from models import Activity
+
+# Full-text index over activity title, notes and room name, kept in sync by
+# database triggers so bulk INSERT/UPDATE paths (imports, bulk actions) and
+# room renames need no application code:
+# - SQLite: an FTS5 table keyed by activity id, ranked with bm25().
+# - PostgreSQL: a trigger-maintained tsvector column with a GIN index,
+#   ranked with ts_rank_cd(). Documents and queries both go through the
+#   `activity_search` configuration, 'simple' plus unaccent, so accents are
+#   folded as SQLite's remove_diacritics does.
+# Every search term is matched as a prefix for type-ahead.
+
+MIN_TERM_LENGTH = 2
+
+SQLITE_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS activity_fts
+       USING fts5(title, notes, location, tokenize = 'unicode61 remove_diacritics 2')""",
+    """CREATE TRIGGER IF NOT EXISTS activity_fts_insert AFTER INSERT ON activity BEGIN
+           INSERT INTO activity_fts (rowid, title, notes, location)
+           VALUES (new.id, new.title, coalesce(new.notes, ''),
+                   coalesce((SELECT name FROM location WHERE id = new.location_id), ''));
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS activity_fts_update AFTER UPDATE OF title, notes, location_id ON activity BEGIN
+           DELETE FROM activity_fts WHERE rowid = old.id;
+           INSERT INTO activity_fts (rowid, title, notes, location)
+           VALUES (new.id, new.title, coalesce(new.notes, ''),
+                   coalesce((SELECT name FROM location WHERE id = new.location_id), ''));
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS activity_fts_delete AFTER DELETE ON activity BEGIN
+           DELETE FROM activity_fts WHERE rowid = old.id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS location_fts_update AFTER UPDATE OF name ON location BEGIN
+           UPDATE activity_fts SET location = new.name
+           WHERE rowid IN (SELECT id FROM activity WHERE location_id = new.id);
+       END""",
+]
+SQLITE_REBUILD = [
+    'DELETE FROM activity_fts',
+    """INSERT INTO activity_fts (rowid, title, notes, location)
+       SELECT activity.id, activity.title, coalesce(activity.notes, ''), coalesce(location.name, '')
+       FROM activity LEFT JOIN location ON location.id = activity.location_id""",
+]
+
+POSTGRES_DDL = [
+    'CREATE EXTENSION IF NOT EXISTS unaccent',
+    """DO $$
+       BEGIN
+           IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = 'activity_search') THEN
+               CREATE TEXT SEARCH CONFIGURATION activity_search (COPY = simple);
+               ALTER TEXT SEARCH CONFIGURATION activity_search
+                   ALTER MAPPING FOR hword, hword_part, word WITH unaccent, simple;
+           END IF;
+       END
+       $$""",
+    'ALTER TABLE activity ADD COLUMN IF NOT EXISTS search_vector tsvector',
+    'CREATE INDEX IF NOT EXISTS ix_activity_search_vector ON activity USING GIN (search_vector)',
+    """CREATE OR REPLACE FUNCTION activity_search_vector() RETURNS trigger AS $$
+       BEGIN
+           NEW.search_vector :=
+               setweight(to_tsvector('activity_search', coalesce(NEW.title, '')), 'A')
+               || setweight(to_tsvector('activity_search', coalesce(
+                      (SELECT name FROM location WHERE id = NEW.location_id), '')), 'B')
+               || setweight(to_tsvector('activity_search', coalesce(NEW.notes, '')), 'C');
+           RETURN NEW;
+       END
+       $$ LANGUAGE plpgsql""",
+    """CREATE OR REPLACE FUNCTION location_search_vector() RETURNS trigger AS $$
+       BEGIN
+           UPDATE activity SET title = title WHERE location_id = NEW.id;
+           RETURN NULL;
+       END
+       $$ LANGUAGE plpgsql""",
+    'DROP TRIGGER IF EXISTS activity_search_vector ON activity',
+    """CREATE TRIGGER activity_search_vector BEFORE INSERT OR UPDATE OF title, notes, location_id
+       ON activity FOR EACH ROW EXECUTE FUNCTION activity_search_vector()""",
+    'DROP TRIGGER IF EXISTS location_search_vector ON location',
+    """CREATE TRIGGER location_search_vector AFTER UPDATE OF name
+       ON location FOR EACH ROW EXECUTE FUNCTION location_search_vector()""",
+]
+POSTGRES_REBUILD = ['UPDATE activity SET title = title']
+
+
+def install():
+    """Create the index and its triggers, rebuilding the index whenever its
+    triggers were missing (a new database, or tables recreated since) or, on
+    PostgreSQL, it was built before accent folding."""
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        installed = db.session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'activity_fts_insert'"
+        )).first()
+        statements = SQLITE_DDL + ([] if installed else SQLITE_REBUILD)
+    elif dialect == 'postgresql':
+        installed = db.session.execute(text(
+            "SELECT 1 FROM pg_trigger WHERE tgname = 'activity_search_vector'"
+        )).first() and db.session.execute(text(
+            "SELECT 1 FROM pg_ts_config WHERE cfgname = 'activity_search'"
+        )).first()
+        statements = POSTGRES_DDL + ([] if installed else POSTGRES_REBUILD)
+    else:
+        return
+    for statement in statements:
+        db.session.execute(text(statement))
+
+
+def search_terms(query):
+    return [term for term in re.findall(r'\w+', query.lower()) if len(term) >= MIN_TERM_LENGTH]
+
+
+def ranked_matches(terms):
+    """Subquery of (id, rank) for activities matching every term as a
+    prefix; a lower rank is a better match."""
+    if db.engine.dialect.name == 'postgresql':
+        vector = literal_column('activity.search_vector')
+        query = func.to_tsquery('activity_search', ' & '.join(f'{term}:*' for term in terms))
+        return (select(Activity.id.label('id'), (-func.ts_rank_cd(vector, query)).label('rank'))
+                .where(vector.op('@@')(query)).subquery())
+
+    fts = table('activity_fts', column('rowid'))
+    match = ' '.join(f'"{term}"*' for term in terms)
+    # bm25 weights per column: title, notes, room
+    rank = func.bm25(literal_column('activity_fts'), 10.0, 2.0, 5.0)
+    return (select(fts.c.rowid.label('id'), rank.label('rank'))
+            .where(literal_column('activity_fts').op('MATCH')(match)).subquery())
+
+
+def match_condition(terms):
+    """WHERE clause keeping the activities matching every term."""
+    return Activity.id.in_(select(ranked_matches(terms).c.id))
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+import background
+from recurrence import add_months
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def month_windows(today, months_before, months_after):
+    """(key, first day, last day) of each month around `today`, matching the
+    start/end a month view of calendar.js requests."""
+    first = add_months(datetime(today.year, today.month, 1), -months_before)
+    for _ in range(months_before + months_after + 1):
+        following = add_months(first, 1)
+        yield first.strftime('%Y-%m'), first, following - timedelta(days=1)
+        first = following
+
+
+def write_atomic(path, body):
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(handle, 'wb') as output:
+        output.write(body)
+    os.replace(temp_path, path)
+
+
+class SnapshotBuilder:
+    """Pre-renders the public calendar's month listings into static files.
+
+    Each month is written as `<YYYY-MM>.<content hash>.json`, so its URL
+    changes with its content and can be cached forever; manifest.json maps
+    months to the current files and is the only file clients revalidate.
+    Rebuilds run on the background scheduler shortly after data changes.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.render = None
+        self.current_version = None
+        self._lock = threading.Lock()
+        self._manifest = (None, None)  # (mtime, parsed manifest)
+
+    def init_app(self, app, render, current_version):
+        """`render(start, end)` returns the JSON body of one month;
+        `current_version()` the calendar data version."""
+        self.app = app
+        self.render = render
+        self.current_version = current_version
+
+    @property
+    def directory(self):
+        return self.app.config['SNAPSHOT_DIR']
+
+    def manifest(self):
+        path = os.path.join(self.directory, MANIFEST_NAME)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        if self._manifest[0] != mtime:
+            with open(path, 'rb') as manifest_file:
+                self._manifest = (mtime, json.load(manifest_file))
+        return self._manifest[1]
+
+    def is_stale(self, version):
+        manifest = self.manifest()
+        return (manifest is None or manifest['version'] != version
+                or manifest['today'] != datetime.now().strftime('%Y-%m-%d'))
+
+    def schedule_rebuild(self, delay=None):
+        """Queue a rebuild; repeated calls within the delay collapse into one."""
+        if delay is None:
+            delay = self.app.config['SNAPSHOT_REBUILD_DELAY']
+        background.ensure_started()
+        background.scheduler.add_job(self.rebuild, 'date', id='snapshot-rebuild', replace_existing=True,
+                                     run_date=datetime.now() + timedelta(seconds=delay))
+
+    def rebuild(self):
+        with self._lock, self.app.app_context():
+            version = self.current_version()
+            if not self.is_stale(version):
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            today = datetime.now()
+            months = {}
+            for key, start, end in month_windows(today, self.app.config['SNAPSHOT_MONTHS_BEFORE'],
+                                                 self.app.config['SNAPSHOT_MONTHS_AFTER']):
+                body = self.render(start, end)
+                filename = f'{key}.{hashlib.sha256(body).hexdigest()[:16]}.json'
+                path = os.path.join(self.directory, filename)
+                if not os.path.exists(path):
+                    write_atomic(path, body)
+                months[key] = {'file': filename, 'start': start.strftime('%Y-%m-%d'),
+                               'end': end.strftime('%Y-%m-%d')}
+
+            previous = self.manifest()
+            manifest = {'version': version, 'today': today.strftime('%Y-%m-%d'), 'months': months}
+            write_atomic(os.path.join(self.directory, MANIFEST_NAME), json.dumps(manifest).encode('utf-8'))
+
+            # Clients holding the previous manifest may still fetch its files
+            keep = {MANIFEST_NAME} | {month['file'] for month in months.values()}
+            if previous:
+                keep |= {month['file'] for month in previous['months'].values()}
+            for filename in os.listdir(self.directory):
+                if filename not in keep and not filename.endswith('.tmp'):
+                    os.remove(os.path.join(self.directory, filename))
+
+
+snapshots = SnapshotBuilder()
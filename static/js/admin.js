@@ -1,3 +1,25 @@
+let currentImportJobUrl = null;
+
+// Poll a background import until it finishes, showing its progress
+async function pollImportJob(statusUrl) {
+    currentImportJobUrl = statusUrl;
+    const status = document.getElementById('importStatus');
+    const progress = document.getElementById('importProgress');
+    status.style.display = '';
+    try {
+        while (true) {
+            const response = await fetch(statusUrl);
+            const job = await response.json();
+            if (!response.ok) throw new Error(job.error || 'Import failed');
+            if (['completed', 'failed', 'cancelled'].includes(job.status)) return job;
+            progress.textContent = `${job.parsed} rows read, ${job.inserted} imported`;
+            await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+    } finally {
+        currentImportJobUrl = null;
+    }
+}
+
 document.addEventListener('DOMContentLoaded', function() {
     // Setup checkbox handlers
     setupCheckboxHandlers();
@@ -7,8 +29,17 @@ document.addEventListener('DOMContentLoaded', function() {
     loadLocationsAndCategories();
     setupForm();
 
-    // Setup time filter handler
-    document.getElementById('timeFilter').addEventListener('change', loadActivities);
+    // Setup list filter handlers
+    loadListFilters();
+    ['timeFilter', 'locationFilter', 'categoryFilter', 'sortOrder'].forEach(id => {
+        document.getElementById(id).addEventListener('change', () => loadActivities());
+    });
+    let searchTimeout;
+    document.getElementById('activitySearch').addEventListener('input', () => {
+        clearTimeout(searchTimeout);
+        searchTimeout = setTimeout(() => loadActivities(), 300);
+    });
+    document.getElementById('loadMoreActivities').addEventListener('click', () => loadActivities(false));
 
     // CSV import handler
     document.getElementById('csvFileInput').addEventListener('change', async (event) => {
@@ -24,16 +55,31 @@ document.addEventListener('DOMContentLoaded', function() {
                 body: formData
             });
             
-            if (!response.ok) throw new Error('Import failed');
-            
             const result = await response.json();
-            if (result.success) {
+            if (!response.ok) throw new Error(result.error || 'Import failed');
+
+            const job = await pollImportJob(result.status_url);
+            if (job.status === 'completed') {
                 loadActivities();
-                alert('Activities imported successfully');
+                alert(`Activities imported successfully: ${job.inserted} added, ${job.updated} updated, ${job.unchanged} unchanged, ${job.removed} removed, ${job.skipped} skipped, ${job.failed} failed, ${job.conflicts} room conflicts`);
+            } else if (job.status === 'cancelled') {
+                alert('Import cancelled');
+            } else {
+                throw new Error(job.error || 'Import failed');
             }
         } catch (error) {
             console.error('Import error:', error);
-            alert('Failed to import activities');
+            alert('Failed to import activities: ' + error.message);
+        } finally {
+            event.target.value = '';
+            document.getElementById('importStatus').style.display = 'none';
+        }
+    });
+
+    document.getElementById('cancelImport').addEventListener('click', () => {
+        if (currentImportJobUrl) {
+            fetch(currentImportJobUrl, { method: 'DELETE' })
+                .catch(error => console.error('Error cancelling import:', error));
         }
     });
 
@@ -80,6 +126,7 @@ document.addEventListener('DOMContentLoaded', function() {
             
             // Uncheck all category checkboxes
             document.querySelectorAll('input[name="categories"]').forEach(cb => cb.checked = false);
+            setupSeriesScope(null);
             
             // Show modal
             const modal = new bootstrap.Modal(document.getElementById('activityModal'));
@@ -268,71 +315,109 @@ function setupForm() {
     });
 }
 
-async function loadActivities() {
+// Cursor for the next page of the admin list, null when everything is loaded
+let nextActivitiesCursor = null;
+// Activities currently listed in the table, by id
+const listedActivities = new Map();
+
+async function loadListFilters() {
     try {
-        const response = await fetch('/api/activities');
-        const activities = await response.json();
-        
-        const tbody = document.getElementById('activitiesList');
-        tbody.innerHTML = '';
+        const [locationsResponse, categoriesResponse] = await Promise.all([
+            fetch('/api/locations'),
+            fetch('/api/categories')
+        ]);
+        const locations = await locationsResponse.json();
+        const categories = await categoriesResponse.json();
 
-        const timeFilter = document.getElementById('timeFilter').value;
-        const today = new Date();
-        today.setHours(0, 0, 0, 0);
-        
-        const filteredActivities = activities.filter(activity => {
-            if (timeFilter === 'current') {
-                const endDate = activity.end_date ? new Date(activity.end_date) : new Date(activity.date);
-                return endDate >= today;
-            }
-            return true;
+        const locationFilter = document.getElementById('locationFilter');
+        locations.forEach(location => {
+            locationFilter.innerHTML += `<option value="${location.id}">${location.name}</option>`;
         });
-        
-        filteredActivities.sort((a, b) => new Date(b.date) - new Date(a.date))
-            .forEach(activity => {
-                const tr = document.createElement('tr');
-                const categoryColor = activity.categories.length > 0 ? activity.categories[0].color : '#6f42c1';
-                const dateStr = formatDate(activity.date);
-                const timeStr = formatTime(activity);
-                
-                tr.innerHTML = `
-                    <td class="align-middle">
-                        <div class="form-check">
-                            <input type="checkbox" class="form-check-input activity-checkbox" value="${activity.id}">
-                        </div>
-                    </td>
-                    <td class="align-middle">${dateStr}</td>
-                    <td class="align-middle">${timeStr}</td>
-                    <td class="align-middle">
-                        <div class="d-flex align-items-center">
-                            <div class="color-dot me-2" style="background-color: ${categoryColor}; width: 12px; height: 12px; border-radius: 50%;"></div>
-                            <div>
-                                <div class="fw-bold">${activity.title}</div>
-                                ${activity.is_recurring ? '<small class="text-muted"><i class="bi bi-arrow-repeat"></i> Recurring</small>' : ''}
-                            </div>
-                        </div>
-                    </td>
-                    <td class="align-middle">${activity.location || ''}</td>
-                    <td class="align-middle">
-                        <div class="d-flex flex-wrap gap-1">
-                            ${activity.categories.map(c => `
-                                <span class="badge" style="background-color: ${c.color}">${c.name}</span>
-                            `).join('')}
-                        </div>
-                    </td>
-                    <td class="align-middle">
-                        <div class="btn-group">
-                            <button class="btn btn-sm btn-outline-primary" onclick="editActivity(${activity.id})">
-                                <i class="bi bi-pencil"></i>
-                            </button>
-                            <button class="btn btn-sm btn-outline-danger" onclick="deleteActivity(${activity.id})">
-                                <i class="bi bi-trash"></i>
-                            </button>
+        const categoryFilter = document.getElementById('categoryFilter');
+        categories.forEach(category => {
+            categoryFilter.innerHTML += `<option value="${category.id}">${category.name}</option>`;
+        });
+    } catch (error) {
+        console.error('Error loading list filters:', error);
+    }
+}
+
+async function loadActivities(reset = true) {
+    try {
+        const params = new URLSearchParams({
+            order: document.getElementById('sortOrder').value
+        });
+        if (document.getElementById('timeFilter').value === 'current') {
+            params.set('upcoming', '1');
+        }
+        const search = document.getElementById('activitySearch').value.trim();
+        if (search) params.set('q', search);
+        const locationId = document.getElementById('locationFilter').value;
+        if (locationId) params.set('location_id', locationId);
+        const categoryId = document.getElementById('categoryFilter').value;
+        if (categoryId) params.set('category_id', categoryId);
+        if (!reset && nextActivitiesCursor) params.set('cursor', nextActivitiesCursor);
+
+        const response = await fetch(`/api/admin/activities?${params}`);
+        if (!response.ok) {
+            throw new Error('Failed to load activities');
+        }
+        const page = await response.json();
+
+        const tbody = document.getElementById('activitiesList');
+        if (reset) {
+            tbody.innerHTML = '';
+            listedActivities.clear();
+        }
+
+        page.activities.forEach(activity => {
+            listedActivities.set(activity.id, activity);
+            const tr = document.createElement('tr');
+            const categoryColor = activity.categories.length > 0 ? activity.categories[0].color : '#6f42c1';
+            const dateStr = formatDate(activity.date);
+            const timeStr = formatTime(activity);
+
+            tr.innerHTML = `
+                <td class="align-middle">
+                    <div class="form-check">
+                        <input type="checkbox" class="form-check-input activity-checkbox" value="${activity.id}">
+                    </div>
+                </td>
+                <td class="align-middle">${dateStr}</td>
+                <td class="align-middle">${timeStr}</td>
+                <td class="align-middle">
+                    <div class="d-flex align-items-center">
+                        <div class="color-dot me-2" style="background-color: ${categoryColor}; width: 12px; height: 12px; border-radius: 50%;"></div>
+                        <div>
+                            <div class="fw-bold">${activity.title}</div>
+                            ${activity.is_recurring ? '<small class="text-muted"><i class="bi bi-arrow-repeat"></i> Recurring</small>' : ''}
                         </div>
-                    </td>
-                `;
-                tbody.appendChild(tr);
-            });
+                    </div>
+                </td>
+                <td class="align-middle">${activity.location || ''}</td>
+                <td class="align-middle">
+                    <div class="d-flex flex-wrap gap-1">
+                        ${activity.categories.map(c => `
+                            <span class="badge" style="background-color: ${c.color}">${c.name}</span>
+                        `).join('')}
+                    </div>
+                </td>
+                <td class="align-middle">
+                    <div class="btn-group">
+                        <button class="btn btn-sm btn-outline-primary" onclick="editActivity(${activity.id})">
+                            <i class="bi bi-pencil"></i>
+                        </button>
+                        <button class="btn btn-sm btn-outline-danger" onclick="deleteActivity(${activity.id})">
+                            <i class="bi bi-trash"></i>
+                        </button>
+                    </div>
+                </td>
+            `;
+            tbody.appendChild(tr);
+        });
+
+        nextActivitiesCursor = page.next_cursor;
+        document.getElementById('loadMoreActivities').style.display = nextActivitiesCursor ? 'inline-block' : 'none';
 
         // Update delete button visibility
         updateDeleteButtonVisibility();
@@ -360,6 +445,16 @@ function formatTime(activity) {
     return timeStr;
 }
 
+// Text of a 409 booking conflict, asking whether to save anyway
+function describeConflicts(result) {
+    const lines = result.conflicts.slice(0, 5).map(conflict => {
+        const other = conflict.conflicts_with[0];
+        return `- ${conflict.activity.date}: ${other.title} (${other.location || ''} ${other.time || ''}-${other.end_time || ''})`;
+    });
+    if (result.conflict_count > lines.length) lines.push(`... (${result.conflict_count - lines.length} more)`);
+    return `This room is already booked:\n${lines.join('\n')}\n\nSave anyway?`;
+}
+
 async function saveActivity() {
     try {
         const activity = {
@@ -389,16 +484,29 @@ async function saveActivity() {
         }
 
         const activityId = document.getElementById('activityId').value;
-        const url = activityId ? `/api/activities/${activityId}` : '/api/activities';
+        let url = activityId ? `/api/activities/${activityId}` : '/api/activities';
+        if (activityId && document.getElementById('seriesScopeFields').style.display !== 'none') {
+            const params = new URLSearchParams({ scope: document.getElementById('editScope').value });
+            if (document.getElementById('occurrenceDateField').style.display !== 'none') {
+                params.set('occurrence_date', document.getElementById('occurrenceDate').value);
+            }
+            url += `?${params}`;
+        }
         const method = activityId ? 'PUT' : 'POST';
 
-        const response = await fetch(url, {
+        const send = () => fetch(url, {
             method: method,
             headers: {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify(activity)
         });
+        let response = await send();
+        if (response.status === 409) {
+            if (!confirm(describeConflicts(await response.json()))) return;
+            activity.allow_conflicts = true;
+            response = await send();
+        }
 
         if (!response.ok) {
             const errorData = await response.json();
@@ -462,6 +570,7 @@ async function editActivity(id) {
                 document.getElementById('recurrence_type').value = activity.recurrence_type || '';
                 document.getElementById('recurrence_end_date').value = activity.recurrence_end_date || '';
                 document.getElementById('recurrenceFields').style.display = activity.is_recurring ? 'block' : 'none';
+                setupSeriesScope(activity);
 
                 // Set categories with retry
                 const categoryCheckboxes = document.querySelectorAll('input[name="categories"]');
@@ -484,13 +593,48 @@ async function editActivity(id) {
     }
 }
 
+function setupSeriesScope(activity) {
+    // Series rows pick the occurrence to edit; materialized rows are one occurrence each
+    const scopeFields = document.getElementById('seriesScopeFields');
+    const occurrenceDateField = document.getElementById('occurrenceDateField');
+    const occurrenceDate = document.getElementById('occurrenceDate');
+    const isSeries = activity && (activity.is_series || activity.series_id);
+
+    scopeFields.style.display = isSeries ? 'block' : 'none';
+    if (!isSeries) return;
+
+    const editScope = document.getElementById('editScope');
+    editScope.value = activity.is_series ? 'series' : 'occurrence';
+    occurrenceDateField.style.display = activity.is_series ? 'block' : 'none';
+    occurrenceDate.value = activity.date;
+    // Saving the whole series sets its start to the date field, so that field
+    // holds the series start for 'series' and the picked occurrence otherwise
+    occurrenceDate.onchange = () => {
+        if (editScope.value === 'series') {
+            editScope.value = 'occurrence';
+        }
+        document.getElementById('date').value = occurrenceDate.value;
+    };
+    editScope.onchange = () => {
+        if (activity.is_series) {
+            document.getElementById('date').value = editScope.value === 'series' ? activity.date : occurrenceDate.value;
+        }
+    };
+}
+
 async function deleteActivity(id) {
     if (!confirm(window.translations.delete_confirmation)) {
         return;
     }
 
+    const activity = listedActivities.get(id);
+    let url = `/api/activities/${id}`;
+    if (activity && activity.series_id && confirm(window.translations.delete_whole_series)) {
+        url += '?scope=series';
+    }
+
     try {
-        const response = await fetch(`/api/activities/${id}`, {
+        const response = await fetch(url, {
             method: 'DELETE'
         });
 
@@ -78,13 +78,58 @@ function createActivityElement(activity, dateStr, startDate, endDate) {
     return element;
 }
 
+let snapshotManifest = null;
+
+// URL of the pre-rendered month matching [start, end] on the public calendar, if any
+async function snapshotUrl(start, end) {
+    if (!window.snapshotManifestUrl || !start) return null;
+    if (!snapshotManifest) {
+        snapshotManifest = fetch(window.snapshotManifestUrl)
+            .then(response => response.ok ? response.json() : null)
+            .catch(() => null);
+    }
+    const manifest = await snapshotManifest;
+    const month = manifest && manifest.months[start.slice(0, 7)];
+    if (!month || month.start !== start || month.end !== end) return null;
+    return new URL(month.file, new URL(window.snapshotManifestUrl, window.location.href)).href;
+}
+
+// Rebuild activity objects from the API's compact listing, which sends each
+// activity as a row of values and its categories once, by id
+function expandCompactListing(listing) {
+    return listing.rows.map(row => {
+        const activity = {};
+        listing.fields.forEach((field, index) => {
+            activity[field] = row[index];
+        });
+        activity.categories = activity.category_ids.map(id => listing.categories[id]);
+        return activity;
+    });
+}
+
 async function fetchActivities() {
     try {
-        const response = await fetch('/api/activities');
+        // Only request the activities overlapping the rendered date range
+        const params = new URLSearchParams();
+        const visibleDates = Array.from(document.querySelectorAll('#calendarDates .timed-activities'))
+            .map(container => container.dataset.date);
+        if (visibleDates.length > 0) {
+            params.set('start', visibleDates[0]);
+            params.set('end', visibleDates[visibleDates.length - 1]);
+        }
+
+        const snapshot = await snapshotUrl(params.get('start'), params.get('end'));
+        let response = snapshot ? await fetch(snapshot) : null;
+        let compact = false;
+        if (!response || !response.ok) {
+            params.set('format', 'compact');
+            response = await fetch(`/api/activities?${params}`);
+            compact = true;
+        }
         if (!response.ok) {
             throw new Error('Network response was not ok');
         }
-        const activities = await response.json();
+        const activities = compact ? expandCompactListing(await response.json()) : await response.json();
 
         // Clear existing activities
         document.querySelectorAll('.all-day-activities, .timed-activities').forEach(container => {
@@ -586,6 +631,16 @@ function formatDate(dateString) {
     });
 }
 
+// Text of a 409 booking conflict, asking whether to save anyway
+function describeConflicts(result) {
+    const lines = result.conflicts.slice(0, 5).map(conflict => {
+        const other = conflict.conflicts_with[0];
+        return `- ${conflict.activity.date}: ${other.title} (${other.location || ''} ${other.time || ''}-${other.end_time || ''})`;
+    });
+    if (result.conflict_count > lines.length) lines.push(`... (${result.conflict_count - lines.length} autres)`);
+    return `Cette salle est déjà réservée :\n${lines.join('\n')}\n\nEnregistrer quand même ?`;
+}
+
 async function saveQuickAddActivity() {
     try {
         const activity = {
@@ -603,7 +658,7 @@ async function saveQuickAddActivity() {
             recurrence_type: document.getElementById('quickAddIsRecurring').checked ?
                 document.getElementById('quickAddRecurrenceType').value : null,
             recurrence_end_date: document.getElementById('quickAddIsRecurring').checked ?
-                document.getElementById('quickAddRecurrenceEndDate').value : null
+                document.getElementById('quickAddRecurrenceEndDate').value || null : null
         };
 
         if (!activity.title || !activity.date) {
@@ -623,19 +678,19 @@ async function saveQuickAddActivity() {
             return;
         }
 
-        // Validate recurrence end date
-        if (activity.is_recurring && !activity.recurrence_end_date) {
-            alert('Veuillez spécifier une date de fin pour l\'activité récurrente');
-            return;
-        }
-
-        const response = await fetch('/api/activities', {
+        const send = () => fetch('/api/activities', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify(activity)
         });
+        let response = await send();
+        if (response.status === 409) {
+            if (!confirm(describeConflicts(await response.json()))) return;
+            activity.allow_conflicts = true;
+            response = await send();
+        }
 
         if (!response.ok) {
             const errorData = await response.json();
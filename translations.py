@@ -55,6 +55,19 @@ translations = {
         'delete_selected': 'Delete Selected',
         'show_all_events': 'Show all events',
         'show_current_future_events': 'Show current and future events',
+        'search_activities': 'Search title, notes or location',
+        'all_locations': 'All locations',
+        'all_categories': 'All categories',
+        'newest_first': 'Newest first',
+        'oldest_first': 'Oldest first',
+        'load_more': 'Load more',
+        'apply_to': 'Apply changes to',
+        'this_occurrence': 'This occurrence',
+        'this_and_following': 'This and following occurrences',
+        'whole_series': 'Whole series',
+        'occurrence_date': 'Occurrence date',
+        'delete_whole_series': 'Also delete every other occurrence of this series?',
+        'cancel_import': 'Cancel import',
         'add_category': 'Add Category',
         'add_location': 'Add Location',
         'name': 'Name',
@@ -140,6 +153,19 @@ translations = {
         'delete_selected': 'Supprimer la sélection',
         'show_all_events': 'Afficher tous les événements',
         'show_current_future_events': 'Afficher les événements en cours et à venir',
+        'search_activities': 'Rechercher titre, notes ou lieu',
+        'all_locations': 'Tous les lieux',
+        'all_categories': 'Toutes les catégories',
+        'newest_first': 'Plus récents d\'abord',
+        'oldest_first': 'Plus anciens d\'abord',
+        'load_more': 'Charger plus',
+        'apply_to': 'Appliquer les modifications à',
+        'this_occurrence': 'Cette occurrence',
+        'this_and_following': 'Cette occurrence et les suivantes',
+        'whole_series': 'Toute la série',
+        'occurrence_date': "Date de l'occurrence",
+        'delete_whole_series': 'Supprimer aussi toutes les autres occurrences de cette série ?',
+        'cancel_import': "Annuler l'import",
         'add_category': 'Ajouter une catégorie',
         'add_location': 'Ajouter un lieu',
         'name': 'Nom',
@@ -0,0 +1,204 @@
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.exc import IntegrityError
+
+import background
+from bookings import booking_interval
+from database import db
+from models import Activity, Category, Location, UsageMonth, UsageRollup
+from recurrence import add_months
+
+
+def month_of(value):
+    return datetime(value.year, value.month, 1)
+
+
+def months_between(first, last):
+    """First day of every month from `first`'s to `last`'s, inclusive."""
+    month = month_of(first)
+    while month <= last:
+        yield month
+        month = add_months(month, 1)
+
+
+def usage_totals(rows):
+    return [{'bookings': row.bookings, 'hours': round(row.minutes / 60, 2), 'clients': row.clients}
+            for row in rows]
+
+
+class UsageRollups:
+    """Room usage per month, aggregated from activities into usage_rollup.
+
+    Writes only invalidate the months they touch (by deleting their
+    usage_month row, in the write's own transaction); stale months are
+    recomputed on the background scheduler after the commit, or on demand
+    by a report that needs them. A report therefore only sums rollup rows,
+    however much history it covers.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.collect = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app, collect):
+        """`collect(start, end)` yields the activity dicts, series expanded,
+        overlapping the days [start, end]."""
+        self.app = app
+        self.collect = collect
+
+    def invalidate_spans(self, spans):
+        """Mark stale the months covered by (first, last) booking spans; a
+        last of None (an open-ended series) reaches every later month."""
+        months = set()
+        open_from = None
+        for first, last in spans:
+            if last is None:
+                open_from = month_of(first) if open_from is None else min(open_from, month_of(first))
+            else:
+                months.update(months_between(first, last))
+        conditions = []
+        if months:
+            conditions.append(UsageMonth.month.in_(sorted(months)))
+        if open_from is not None:
+            conditions.append(UsageMonth.month >= open_from)
+        if conditions:
+            db.session.execute(delete(UsageMonth).where(db.or_(*conditions)))
+
+    def invalidate(self, condition):
+        """Mark stale the months of the activities matching `condition`; call it
+        before a change for the months they leave and after for the ones they reach."""
+        spans = []
+        for row in db.session.execute(
+            select(Activity.start_at, Activity.end_at, Activity.is_series, Activity.recurrence_end_date)
+            .where(condition)
+        ):
+            if not row.is_series:
+                spans.append((row.start_at, row.end_at))
+            elif row.recurrence_end_date is None:
+                spans.append((row.start_at, None))
+            else:
+                spans.append((row.start_at, row.recurrence_end_date + timedelta(days=1) + (row.end_at - row.start_at)))
+        self.invalidate_spans(spans)
+
+    def forget_category(self, category_id):
+        # Room totals do not depend on categories; only its breakdown rows go
+        db.session.execute(delete(UsageRollup).where(UsageRollup.category_id == category_id))
+
+    def stale_months(self, first, last):
+        fresh = set(db.session.execute(
+            select(UsageMonth.month).where(UsageMonth.month.between(month_of(first), last))
+        ).scalars())
+        return [month for month in months_between(first, last) if month not in fresh]
+
+    def refresh_month(self, month):
+        """Recompute one month's rows. A booking counts (with its clients) in
+        the month it starts in; its minutes count in each month it overlaps."""
+        following = add_months(month, 1)
+        default_duration = timedelta(minutes=self.app.config['BOOKING_DEFAULT_MINUTES'])
+        totals = {}
+        for item in self.collect(month, following - timedelta(days=1)):
+            start, end = booking_interval(item, default_duration)
+            minutes = max(int((min(end, following) - max(start, month)).total_seconds() // 60), 0)
+            starts_here = month <= start < following
+            if not (starts_here or minutes):
+                continue
+            for category_id in [None] + item.get('category_ids', []):
+                row = totals.setdefault((item.get('location_id'), category_id), [0, 0, 0])
+                if starts_here:
+                    row[0] += 1
+                    row[2] += item.get('client_count') or 0
+                row[1] += minutes
+
+        db.session.execute(delete(UsageRollup).where(UsageRollup.month == month))
+        if totals:
+            db.session.execute(insert(UsageRollup), [
+                {'month': month, 'location_id': location_id, 'category_id': category_id,
+                 'bookings': bookings, 'booked_minutes': minutes, 'clients': clients}
+                for (location_id, category_id), (bookings, minutes, clients) in totals.items()
+            ])
+        db.session.add(UsageMonth(month=month, refreshed_at=datetime.utcnow()))
+
+    def refresh(self, months):
+        """Recompute `months`, committing each on its own."""
+        with self._lock:
+            for month in months:
+                if db.session.get(UsageMonth, month):
+                    continue
+                try:
+                    self.refresh_month(month)
+                    db.session.commit()
+                except IntegrityError:
+                    # Refreshed concurrently by another process
+                    db.session.rollback()
+
+    def schedule_refresh(self, delay=None):
+        """Queue a refresh of every stale month; repeated calls collapse into one."""
+        if delay is None:
+            delay = self.app.config['USAGE_REFRESH_DELAY']
+        background.ensure_started()
+        background.scheduler.add_job(self.refresh_stale, 'date', id='usage-refresh', replace_existing=True,
+                                     run_date=datetime.now() + timedelta(seconds=delay))
+
+    def refresh_stale(self):
+        """Refresh the stale months from the first booking up to the recurrence horizon."""
+        with self.app.app_context():
+            first, last = db.session.execute(select(func.min(Activity.start_at), func.max(Activity.end_at))).one()
+            if first is None:
+                return
+            horizon = datetime.now() + timedelta(days=self.app.config['RECURRENCE_HORIZON_DAYS'])
+            self.refresh(self.stale_months(first, max(last, horizon)))
+
+    def rebuild(self):
+        """Drop every rollup and recompute them in the background."""
+        db.session.execute(delete(UsageMonth))
+        db.session.execute(delete(UsageRollup))
+        db.session.commit()
+        self.schedule_refresh(delay=0)
+
+    def report(self, first, last, location_id=None):
+        """Bookings, hours and clients over the months [first, last], in
+        total and by month, room and category."""
+        self.refresh(self.stale_months(first, last))
+
+        scope = [UsageRollup.month.between(month_of(first), last)]
+        if location_id:
+            scope.append(UsageRollup.location_id == location_id)
+        measures = (func.count(UsageRollup.id).label('rows'),
+                    func.coalesce(func.sum(UsageRollup.bookings), 0).label('bookings'),
+                    func.coalesce(func.sum(UsageRollup.booked_minutes), 0).label('minutes'),
+                    func.coalesce(func.sum(UsageRollup.clients), 0).label('clients'))
+        room_totals = scope + [UsageRollup.category_id.is_(None)]
+
+        total = db.session.execute(select(*measures).where(*room_totals)).one()
+        months = db.session.execute(
+            select(UsageRollup.month, *measures).where(*room_totals)
+            .group_by(UsageRollup.month).order_by(UsageRollup.month)
+        ).all()
+        locations = db.session.execute(
+            select(UsageRollup.location_id, Location.name, *measures)
+            .outerjoin(Location, Location.id == UsageRollup.location_id).where(*room_totals)
+            .group_by(UsageRollup.location_id, Location.name).order_by(func.sum(UsageRollup.booked_minutes).desc())
+        ).all()
+        categories = db.session.execute(
+            select(UsageRollup.category_id, Category.name, *measures)
+            .join(Category, Category.id == UsageRollup.category_id).where(*scope)
+            .group_by(UsageRollup.category_id, Category.name).order_by(func.sum(UsageRollup.booked_minutes).desc())
+        ).all()
+
+        return {
+            'start': month_of(first).strftime('%Y-%m'),
+            'end': month_of(last).strftime('%Y-%m'),
+            'totals': usage_totals([total])[0],
+            'months': [dict(totals, month=row.month.strftime('%Y-%m'))
+                       for row, totals in zip(months, usage_totals(months))],
+            'locations': [dict(totals, location_id=row.location_id, location=row.name)
+                          for row, totals in zip(locations, usage_totals(locations))],
+            'categories': [dict(totals, category_id=row.category_id, category=row.name)
+                           for row, totals in zip(categories, usage_totals(categories))]
+        }
+
+
+usage_rollups = UsageRollups()
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+
+from database import db
+from models import User
+
+
+class UserCache:
+    """Per-process cache of user rows for flask-login's user_loader.
+
+    Rows are kept as plain column values and turned back into a User attached
+    to the request's session without a query, so views can still modify and
+    commit `current_user`. Any flushed change to a user (role, password,
+    deletion...) evicts it in this process straight away and again once
+    committed; other processes see it within `ttl` seconds.
+    """
+
+    def __init__(self, ttl=60, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # user id -> (expires_at, column values)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.ttl = app.config.get('USER_CACHE_TTL', self.ttl)
+        self.max_entries = app.config.get('USER_CACHE_MAX_ENTRIES', self.max_entries)
+
+    def load(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] >= time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                values = entry[1]
+            else:
+                self.misses += 1
+                values = None
+
+        if values is None:
+            user = db.session.get(User, user_id)
+            if user is not None:
+                self._store(user_id, {attr.key: getattr(user, attr.key) for attr in db.inspect(User).column_attrs})
+            return user
+
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def _store(self, user_id, values):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, values)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+user_cache = UserCache()
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def forget_changed_user(mapper, connection, user):
+    # Evicted at flush so this process never serves the old row, and again
+    # after commit in case another request cached it in between
+    user_cache.invalidate(user.id)
+    object_session(user).info.setdefault('changed_users', set()).add(user.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def forget_committed_users(session):
+    for user_id in session.info.pop('changed_users', ()):
+        user_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_rolled_back_users(session, previous_transaction):
+    session.info.pop('changed_users', None)